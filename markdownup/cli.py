@@ -2,19 +2,23 @@
 """コマンドライン引数解析とメイン関数"""
 
 import argparse
+import http.server
 import sys
 import os
 import socket
-import socketserver
 from pathlib import Path
 
-from .constants import DEFAULT_PORT, MARKDOWN_AVAILABLE
+from .constants import DEFAULT_PORT, IS_WINDOWS, MARKDOWN_AVAILABLE
 from .handler import PrettyMarkdownHTTPRequestHandler
 from .service import save_pid, remove_pid, stop_service, start_service, status_service
-from .utils import (
-    find_available_port, resolve_target_directory,
-    is_directory_only_invocation, is_port_without_start_invocation
-)
+from .utils import find_available_port, resolve_target_directory
+
+
+class MarkdownHTTPServer(http.server.ThreadingHTTPServer):
+    """リクエストごとにスレッドで処理するHTTPサーバー（__sig__ ポーリング中も変換を待たせない）"""
+    daemon_threads = True
+    # WindowsのSO_REUSEADDRは使用中ポートへの bind も許してしまうため無効にする
+    allow_reuse_address = not IS_WINDOWS
 
 
 def build_argument_parser():
@@ -38,10 +42,11 @@ def build_argument_parser():
   pip install markdown pygments
         """)
 
+    # --port / --directory は指定の有無を判定するため既定値を None にし、解析後に補う
     parser.add_argument(
         '--port', '-p',
         type=int,
-        default=DEFAULT_PORT,
+        default=None,
         help=f'ポート番号（--start と併用。デフォルト: {DEFAULT_PORT}）'
     )
 
@@ -55,7 +60,7 @@ def build_argument_parser():
     parser.add_argument(
         '--directory', '-d',
         type=str,
-        default='.',
+        default=None,
         help='サーバーのルートディレクトリ（デフォルト: カレントディレクトリ）'
     )
 
@@ -86,34 +91,34 @@ def build_argument_parser():
     return parser
 
 
-def parse_arguments():
-    """コマンドライン引数をパース"""
-    parser = build_argument_parser()
-    return parser.parse_args()
-
-
 def main():
     """メイン処理"""
     # 引数なしの場合はヘルプを表示
     # ただし argcomplete の補完実行（_ARGCOMPLETE=1）時はここで抜けると補完が動かないため除外
+    parser = build_argument_parser()
     if len(sys.argv) == 1 and os.environ.get("_ARGCOMPLETE") != "1":
-        parser = build_argument_parser()
         parser.print_help()
         return
 
-    # -d/--directory 単体での起動は廃止（ヘルプ表示に寄せる）
+    # 引数の解析は1回だけ行い、起動方法の判定も解析結果から行う
+    args = parser.parse_args()
+
+    # -d/--directory 単体での起動は廃止、--start なしの --port/-p も同様（ヘルプ表示に寄せる）
     # ただし argcomplete の補完実行時はここで抜けない
     if os.environ.get("_ARGCOMPLETE") != "1":
-        if is_directory_only_invocation(sys.argv[1:]):
-            parser = build_argument_parser()
-            parser.print_help()
-            return
-        if is_port_without_start_invocation(sys.argv[1:]):
-            parser = build_argument_parser()
+        has_other_options = (
+            args.port is not None or args.start or args.stop or args.status or args.header or args._child
+        )
+        is_directory_only = args.directory is not None and not has_other_options
+        is_port_without_start = args.port is not None and not args.start and not args._child
+        if is_directory_only or is_port_without_start:
             parser.print_help()
             return
-    
-    args = parse_arguments()
+
+    if args.port is None:
+        args.port = DEFAULT_PORT
+    if args.directory is None:
+        args.directory = '.'
     
     # --status オプションの処理
     if args.status:
@@ -150,9 +155,13 @@ def main():
     handler = PrettyMarkdownHTTPRequestHandler
     handler.header_mode = args.header
     handler.base_dir_name = target_dir.name  # ベースディレクトリ名を設定
+    handler.base_dir_resolved = Path('.').resolve()  # __sig__ でのパス解決を毎回行わない
     if args.header:
         print(f"[*] ヘッダーモード有効: credits.md を印刷時に表示します")
-    if not MARKDOWN_AVAILABLE:
+    if MARKDOWN_AVAILABLE:
+        # 拡張機能の構築を起動時に済ませ、最初の表示を待たせない
+        handler.prepare_markdown()
+    else:
         print("[!] markdownパッケージがインストールされていません")
         print("   最適な表示のために以下をインストールしてください:")
         print("   pip install markdown pygments\n")
@@ -174,10 +183,10 @@ def main():
         save_pid(port)
         
         # サーバー起動（プラットフォームに応じて対応）
-        if sys.platform == 'win32':
+        if IS_WINDOWS:
             # WindowsではIPv4で起動（localhostでリッスン）
-            socketserver.TCPServer.address_family = socket.AF_INET
-            with socketserver.TCPServer(("localhost", port), handler) as httpd:
+            MarkdownHTTPServer.address_family = socket.AF_INET
+            with MarkdownHTTPServer(("localhost", port), handler) as httpd:
                 if port != args.port:
                     print(f"[OK] ポート {port} でサーバーを起動しました（代替ポート）")
                 else:
@@ -193,8 +202,8 @@ def main():
                 httpd.serve_forever()
         else:
             # Linux/macOSではIPv6対応（IPv4もデュアルスタック）
-            socketserver.TCPServer.address_family = socket.AF_INET6
-            with socketserver.TCPServer(("::", port), handler, bind_and_activate=False) as httpd:
+            MarkdownHTTPServer.address_family = socket.AF_INET6
+            with MarkdownHTTPServer(("::", port), handler, bind_and_activate=False) as httpd:
                 # IPv6ソケットでIPv4も受け入れる設定（デュアルスタック）
                 httpd.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
                 httpd.server_bind()
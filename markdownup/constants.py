@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 """定数定義とmarkdownライブラリの利用可能性チェック"""
 
+import sys
 from pathlib import Path
 
+# 実行環境（起動中に変わらないため、判定は読み込み時の1回だけにする）
+IS_WINDOWS = sys.platform == 'win32'
+
 # デフォルト設定
 DEFAULT_PORT = 8000
 FALLBACK_PORTS = [8001, 8080, 8888, 9000, 3000]
@@ -16,3 +20,17 @@ try:
     MARKDOWN_AVAILABLE = True
 except ImportError:
     MARKDOWN_AVAILABLE = False
+
+# charset-normalizer の利用可能性チェック（UTF-8以外のファイルの文字コード判定に使用、任意）
+try:
+    import charset_normalizer  # noqa: F401
+    CHARSET_NORMALIZER_AVAILABLE = True
+except ImportError:
+    CHARSET_NORMALIZER_AVAILABLE = False
+
+# pymdownx の利用可能性チェック（~~取り消し線~~ の変換に使用、任意）
+try:
+    import pymdownx  # noqa: F401
+    PYMDOWNX_AVAILABLE = True
+except ImportError:
+    PYMDOWNX_AVAILABLE = False
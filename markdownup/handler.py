@@ -1,18 +1,34 @@
 # -*- coding: utf-8 -*-
 """HTTPリクエストハンドラー"""
 
+import functools
+import hashlib
 import html
 import http.server
 import json
+import os
 import re
+import stat
+import threading
+import time
 import urllib.parse
+import zlib
+from collections import OrderedDict
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
 
-from .constants import MARKDOWN_AVAILABLE
-from .templates import HTML_TEMPLATE, SETTINGS_SECTION_HTML, get_print_html_template
+from .constants import CHARSET_NORMALIZER_AVAILABLE, MARKDOWN_AVAILABLE, PYMDOWNX_AVAILABLE
+from .templates import (
+    CODE_COPY_BUTTON_HTML, HTML_TEMPLATE_PARTS, PRINT_HTML_TEMPLATE, PRINT_HTML_TEMPLATE_PARTS,
+    SETTINGS_SECTION_BYTES, render_template_chunks
+)
 from .utils import githubish_slugify
 
+# charset-normalizer（利用可能な場合のみ）
+if CHARSET_NORMALIZER_AVAILABLE:
+    import charset_normalizer
+
 # Markdownライブラリ（利用可能な場合のみ）
 if MARKDOWN_AVAILABLE:
     import markdown
@@ -24,6 +40,37 @@ if MARKDOWN_AVAILABLE:
     from markdown.extensions.sane_lists import SaneListExtension
     from markdown.extensions.attr_list import AttrListExtension
 
+# pymdownx.tilde（利用可能な場合のみ）
+if MARKDOWN_AVAILABLE and PYMDOWNX_AVAILABLE:
+    from pymdownx.tilde import DeleteSubExtension
+
+
+def _is_markdown_name(name):
+    """ファイル名の拡張子が .md かどうか（Path.suffix と同じく先頭ドットのみの名前は除外）"""
+    return os.path.splitext(name)[1].lower() == '.md'
+
+
+def _get_iov_max():
+    """1回の sendmsg に渡せるバッファ数の上限（取得できない場合は Linux/macOS の既定値）"""
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        iov_max = -1
+    return iov_max if iov_max > 0 else 1024
+
+
+_IOV_MAX = _get_iov_max()
+
+_STRIKETHROUGH_PATTERN = re.compile(r'~~(.*?)~~')
+
+
+@functools.lru_cache(maxsize=4096)
+def _apply_strikethrough(text):
+    """~~取り消し線~~ を <del> に変換する（フォールバック変換用。同じ断片は何度も現れるため結果をキャッシュする）"""
+    if '~~' not in text:
+        return text
+    return _STRIKETHROUGH_PATTERN.sub(r'<del>\1</del>', text)
+
 
 class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """MarkdownをHTMLに変換して表示するハンドラー"""
@@ -34,17 +81,62 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     script_dir = Path(__file__).parent.parent
     # 起動時に指定されたベースディレクトリ名
     base_dir_name = ''
+    # アクセスログを出さないエンドポイント（ポーリング等で頻繁に呼ばれ、ログが埋もれるため）
+    quiet_log_paths = ('/__sig__', '/__nav__', '/__logo__', '/__credits__')
+    # 小さな応答（__sig__ 等）が Nagle アルゴリズムと遅延ACKで待たされないよう TCP_NODELAY を設定
+    disable_nagle_algorithm = True
+    # __sig__ ロングポーリングで変化を待つ最大秒数と、その間の再確認間隔
+    # （毎回は対象自身の stat のみ確認し、ディレクトリ走査を伴う再計算は sig_rescan_interval ごとに行う）
+    sig_wait_timeout = 25
+    sig_wait_interval = 0.5
+    sig_rescan_interval = 2
+    # ロゴ・credits.md をブラウザにキャッシュさせる秒数
+    static_max_age = 3600
+    # 起動時に解決したルートディレクトリの絶対パス（未設定なら初回参照時に解決）
+    base_dir_resolved = None
     _CREDITS_TOKEN_PATTERN = re.compile(
         r'\{\{\s*(TODAY|CURRENT_DATE|NOW)\s*(?::([^{}]+))?\s*\}\}'
     )
+    # UTF-8で読めなかった場合のエンコーディング候補（判定・試行の順）
+    _FALLBACK_ENCODINGS = ('shift_jis', 'cp932', 'euc-jp', 'iso-2022-jp', 'latin-1')
+    # ```mermaid ... ``` ブロック
+    _MERMAID_BLOCK_PATTERN = re.compile(r'```mermaid\s*\n(.*?)```', re.DOTALL)
+    # インラインTOCに載せない見出し（本文側の「目次」見出し等）
+    _INLINE_TOC_SKIP_NAMES = frozenset(('目次', 'TOC', 'Table of Contents'))
+    # 変換後HTMLに残したプレースホルダー（改ページはmarkdownライブラリが<p>タグで囲む場合も含む）
+    _PLACEHOLDER_PATTERN = re.compile(
+        r'<p><!--PAGEBREAK8--></p>|<!--PAGEBREAK8-->|<!--MERMAID_PLACEHOLDER_(\d+)-->'
+    )
+    # 変換後HTMLのコードブロックと、その中身が空かどうかを見るためのタグ
+    _PRE_BLOCK_PATTERN = re.compile(r'<pre[\s>].*?</pre>', re.DOTALL)
+    _HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+    # 強制改ページマーカー（8つ以上のハイフンのみの行）
+    _PAGEBREAK_PATTERN = re.compile(r'^-{8,}$', re.MULTILINE)
+    # フォールバック変換（markdown 未導入時）で使うパターンと、行頭記号 -> タグの対応
+    _FALLBACK_BLOCK_PATTERN = re.compile(r'(#{1,4}|[-*]) (.*)')
+    _FALLBACK_BLOCK_TAGS = {'#': 'h1', '##': 'h2', '###': 'h3', '####': 'h4', '-': 'li', '*': 'li'}
+    # 変換済みHTMLのキャッシュ: (解決済みパス, 内容のダイジェスト) -> (HTMLチャンク, gzip圧縮済みバイト列)
+    # __sig__ ポーリング後の再読み込みで同じファイルを何度も変換しないようにする
+    render_cache_size = 256
+    _render_cache = OrderedDict()
+    _render_cache_lock = threading.Lock()
+    # 最後に読み込んだときのファイルの状態: 解決済みパス -> (st_mtime_ns, st_size, 内容のダイジェスト)
+    # 更新日時・サイズが変わらない間はファイルを読まずにキャッシュを引き、変わったときは読み込んで
+    # 内容が同じ（touch や同じ内容での保存）なら変換を省く
+    _source_states = {}
+    # Accept-Encoding: gzip のクライアントに送るMarkdownページの圧縮レベル
+    gzip_level = 6
+    # 空いている変換用Markdownインスタンス（起動時または初回変換時に構築し、以降は reset() して再利用）
+    # ThreadingHTTPServer はリクエストごとにスレッドを作るため、スレッドローカルではなく
+    # 使い回し用のプールにし、変換中はインスタンスを借りることで他のリクエストの変換を待たせない
+    _markdown_pool = []
+    _markdown_lock = threading.Lock()
     
     def do_GET(self):
         """GETリクエスト処理"""
         # パスをデコードして正規化
         parsed = urllib.parse.urlparse(self.path)
         path_str = urllib.parse.unquote(parsed.path).strip('/')
-        query_params = urllib.parse.parse_qs(parsed.query)
-        local_path = Path('.') / path_str
         
         # 0. __credits__ エンドポイント（~/.markdownup/credits.md を返す）
         if path_str == '__credits__' and self.header_mode:
@@ -58,28 +150,106 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         
         # 0.5. __nav__ エンドポイント（ナビゲーション情報を返す）
         if path_str == '__nav__':
-            nav_path = query_params.get('path', [''])[0]
+            nav_path = self._get_query_param(parsed.query, 'path')
             self.send_nav_info(nav_path)
             return
 
         # 0.6. __sig__ エンドポイント（更新検知用シグネチャを返す）
         if path_str == '__sig__':
-            sig_path = query_params.get('path', [''])[0]
-            self.send_sig_info(sig_path)
+            sig_path = self._get_query_param(parsed.query, 'path')
+            wait = self._get_query_param(parsed.query, 'wait') == '1'
+            self.send_sig_info(sig_path, wait=wait)
+            return
+        
+        # ルートディレクトリ配下の実パスに変換（".." を含むパス等でルートの外を指す場合は拒否）
+        local_path = self.resolve_local_path(path_str)
+        if local_path is None:
+            self.send_error(403, 'Access denied')
             return
         
+        # ディレクトリ・Markdownの判定は1回の stat で行い、結果は変換キャッシュの検証にも使う
+        st = self._stat_or_none(local_path)
+        
         # 1. ディレクトリの場合
-        if local_path.is_dir():
+        if st is not None and stat.S_ISDIR(st.st_mode):
             self.send_directory_listing(local_path)
             return
         
         # 2. Markdownファイルの場合
-        if path_str.endswith('.md') and local_path.exists():
-            self.send_markdown_as_html(local_path)
+        if st is not None and path_str.endswith('.md') and stat.S_ISREG(st.st_mode):
+            self.send_markdown_as_html(local_path, st)
+            return
+        
+        # 3. 存在しないパス（favicon 等の繰り返しの問い合わせ）は、標準の処理で stat し直さずに 404 を返す
+        if st is None:
+            self.send_error(404, 'File not found')
             return
         
-        # 3. その他（画像など）は標準の処理に任せる
+        # 4. その他（画像など）は標準の処理に任せる
         super().do_GET()
+
+    def do_HEAD(self):
+        """HEADリクエスト処理（Markdown変換・一覧生成は行わずヘッダーのみ返す）"""
+        parsed = urllib.parse.urlparse(self.path)
+        path_str = urllib.parse.unquote(parsed.path).strip('/')
+        local_path = self.resolve_local_path(path_str)
+        if local_path is None:
+            self.send_error(403, 'Access denied')
+            return
+
+        st = self._stat_or_none(local_path)
+        is_dir = st is not None and stat.S_ISDIR(st.st_mode)
+        if is_dir or (st is not None and path_str.endswith('.md') and stat.S_ISREG(st.st_mode)):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            if not is_dir:
+                # 変換済みであればその長さを返す（未変換なら長さは省略し、変換もしない）
+                try:
+                    entry = self._get_cached_page(self._render_cache_key(local_path.resolve(), st))
+                except OSError:
+                    entry = None
+                if entry is not None:
+                    body, gzipped = self._select_page_body(entry)
+                    if gzipped:
+                        self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Vary', 'Accept-Encoding')
+                    self.send_header('Content-Length', str(sum(len(chunk) for chunk in body)))
+            self.send_no_cache_headers()
+            self.end_headers()
+            return
+
+        if st is None:
+            self.send_error(404, 'File not found')
+            return
+
+        super().do_HEAD()
+
+    @staticmethod
+    def _stat_or_none(path):
+        """パスの stat 結果を返す（存在しない・アクセスできない場合は None）"""
+        try:
+            return os.stat(path)
+        except (OSError, ValueError):
+            return None
+
+    def log_request(self, code='-', size='-'):
+        """アクセスログを出力（quiet_log_paths のエンドポイントは整形・出力ごと省略）"""
+        path = getattr(self, 'path', None) or ''
+        if path.startswith(self.quiet_log_paths):
+            return
+        super().log_request(code, size)
+
+    @staticmethod
+    def _get_query_param(query, name):
+        """クエリ文字列から指定パラメータの最初の値を取り出す（無ければ空文字）"""
+        # 必要なエンドポイントでだけ、必要なキーだけを取り出す（parse_qs の辞書構築を避ける）
+        if not query:
+            return ''
+        prefix = name + '='
+        for part in query.split('&'):
+            if part.startswith(prefix) and len(part) > len(prefix):
+                return urllib.parse.unquote_plus(part[len(prefix):])
+        return ''
     
     def do_POST(self):
         """POSTリクエスト処理（編集内容の保存）"""
@@ -115,10 +285,8 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 return
             
             # セキュリティチェック: パストラバーサル防止
-            local_path = Path('.') / file_path.strip('/')
-            try:
-                local_path.resolve().relative_to(Path('.').resolve())
-            except ValueError:
+            local_path = self.resolve_local_path(file_path.strip('/'), always_resolve=True)
+            if local_path is None:
                 self.send_error(403, 'Access denied')
                 return
             
@@ -126,11 +294,7 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             local_path.write_text(content, encoding='utf-8')
             
             # 成功レスポンス
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            response = json.dumps({'success': True})
-            self.wfile.write(response.encode('utf-8'))
+            self._send_json({'success': True})
             
         except Exception as e:
             self.send_error(500, f'Save error: {e}')
@@ -141,13 +305,23 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if credits_path.exists():
             try:
                 with open(credits_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                content = self.expand_credits_tokens(content)
+                    raw_content = f.read()
+                content = self.expand_credits_tokens(raw_content)
+                body = content.encode('utf-8')
+                # 日時トークンを含む場合は内容が時刻で変わるため、毎回再検証させる
+                if content == raw_content:
+                    cache_control = f'public, max-age={self.static_max_age}'
+                else:
+                    cache_control = 'no-cache'
+                etag = f'"{zlib.crc32(body):x}-{len(body):x}"'
+                if self._etag_matches(etag):
+                    self._send_not_modified(etag, cache_control)
+                    return
                 self.send_response(200)
                 self.send_header('Content-Type', 'text/plain; charset=utf-8')
-                self.send_no_cache_headers()
-                self.end_headers()
-                self.wfile.write(content.encode('utf-8'))
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers_with_body(body)
             except Exception as e:
                 self.send_error(500, f'Error reading credits.md: {e}')
         else:
@@ -184,12 +358,21 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if logo_path.exists():
             try:
                 with open(logo_path, 'rb') as f:
-                    content = f.read()
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/png')
-                self.send_no_cache_headers()
-                self.end_headers()
-                self.wfile.write(content)
+                    st = os.fstat(f.fileno())
+                    cache_control = f'public, max-age={self.static_max_age}'
+                    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+                    if self._etag_matches(etag):
+                        self._send_not_modified(etag, cache_control)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/png')
+                    self.send_header('Content-Length', str(st.st_size))
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', cache_control)
+                    self.end_headers()
+                    # カーネル内でファイルからソケットへ直接転送する
+                    # （os.sendfile が使えない環境では socket.sendfile が send にフォールバックする）
+                    self.connection.sendfile(f)
             except Exception as e:
                 self.send_error(500, f'Error reading logo.png: {e}')
         else:
@@ -223,42 +406,42 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     if parent == Path('.'):
                         result['parent'] = '/'
                     else:
-                        result['parent'] = '/' + str(parent).replace('\\', '/') + '/'
+                        result['parent'] = '/' + parent.as_posix() + '/'
                 self._send_json(result)
                 return
             
             # ファイルの場合
             # 親ディレクトリ
             if current_item.parent != Path('.'):
-                result['parent'] = '/' + str(current_item.parent).replace('\\', '/') + '/'
+                result['parent'] = '/' + current_item.parent.as_posix() + '/'
             else:
                 result['parent'] = '/'
             
             # 同ディレクトリ内のMarkdownファイルをファイル名順で取得
             if current_item.suffix.lower() == '.md':
                 parent_dir = current_item.parent
-                md_files = sorted([
-                    f for f in parent_dir.iterdir()
-                    if f.is_file() and f.suffix.lower() == '.md' and not f.name.startswith('.')
-                ], key=lambda f: f.name.lower())
+                # os.scandir の DirEntry は種別判定に readdir の結果を使うため、名前で絞ってから判定する
+                with os.scandir(parent_dir) as it:
+                    md_names = sorted(
+                        (
+                            entry.name for entry in it
+                            if _is_markdown_name(entry.name) and not entry.name.startswith('.') and entry.is_file()
+                        ),
+                        key=str.lower
+                    )
                 
                 # 現在のファイルのインデックスを探す
                 try:
-                    current_index = next(
-                        i for i, f in enumerate(md_files)
-                        if f.name == current_item.name
-                    )
+                    current_index = md_names.index(current_item.name)
                     
                     # 前のページ
                     if current_index > 0:
-                        prev_file = md_files[current_index - 1]
-                        result['prevPage'] = '/' + str(prev_file).replace('\\', '/')
+                        result['prevPage'] = '/' + (parent_dir / md_names[current_index - 1]).as_posix()
                     
                     # 次のページ
-                    if current_index < len(md_files) - 1:
-                        next_file = md_files[current_index + 1]
-                        result['nextPage'] = '/' + str(next_file).replace('\\', '/')
-                except StopIteration:
+                    if current_index < len(md_names) - 1:
+                        result['nextPage'] = '/' + (parent_dir / md_names[current_index + 1]).as_posix()
+                except ValueError:
                     pass
             
             self._send_json(result)
@@ -266,145 +449,251 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             self._send_json({'error': str(e)})
 
-    def send_sig_info(self, requested_path):
-        """更新検知用のシグネチャをJSONで返す（ファイル/ディレクトリ）"""
-        import hashlib
-
+    def send_sig_info(self, requested_path, wait=False):
+        """
+        更新検知用のシグネチャをJSONで返す（ファイル/ディレクトリ）。
+        wait=True の場合はロングポーリング: If-None-Match のシグネチャから変化するまで
+        （最大 sig_wait_timeout 秒）サーバー側で待ち、変化がなければ304を返す。
+        """
         try:
-            # ブラウザの pathname（例: "/foo/bar.md" や "/foo/"）を想定
-            p = (requested_path or '').split('?', 1)[0]
-            p = urllib.parse.unquote(p)
-            p = p.lstrip('/')
+            target = self.resolve_sig_target(requested_path)
+            result = self.compute_sig(target) if target is not None else None
 
-            base_dir = Path('.').resolve()
-            target = (Path('.') / p) if p else Path('.')
+            # If-None-Match: * は常に一致するため、待たずにすぐ304を返す
+            if wait and result is not None and '*' not in self._if_none_match_tags():
+                now = time.monotonic()
+                deadline = now + self.sig_wait_timeout
+                next_rescan = now + self.sig_rescan_interval
+                last_state = self._stat_state(target)
+                while self._etag_matches(self._sig_etag(*result)) and time.monotonic() < deadline:
+                    time.sleep(self.sig_wait_interval)
+                    # 対象自身（ファイル、またはディレクトリのエントリ増減）が変わっていなければ、
+                    # 直下のファイルの更新を拾うための再計算は一定間隔に抑える
+                    state = self._stat_state(target)
+                    if state == last_state and time.monotonic() < next_rescan:
+                        continue
+                    last_state = state
+                    next_rescan = time.monotonic() + self.sig_rescan_interval
+                    result = self.compute_sig(target)
+                    if result is None:
+                        break
 
-            # パストラバーサルを拒否（base_dir配下のみ許可）
-            try:
-                target_resolved = target.resolve()
-                target_resolved.relative_to(base_dir)
-            except Exception:
+            if result is None:
                 self._send_json({'exists': False})
                 return
+            self._send_sig(*result)
+        except Exception as e:
+            self._send_json({'exists': False, 'error': str(e)})
 
-            if target_resolved.is_dir():
-                # ディレクトリ一覧に影響するもの（直下のディレクトリ + .md ファイル）でシグネチャ生成
-                items = list(target_resolved.iterdir())
-                dirs = [d for d in items if d.is_dir()]
-                files = [f for f in items if f.is_file() and f.suffix.lower() == '.md']
+    @classmethod
+    def _stat_state(cls, path):
+        """変化の検知に使う (mtime_ns, size) を返す（存在しなければ None）"""
+        st = cls._stat_or_none(path)
+        return None if st is None else (st.st_mtime_ns, st.st_size)
 
-                entries = []
-                for d in dirs:
-                    try:
-                        entries.append(('d', d.name, d.stat().st_mtime_ns))
-                    except Exception:
-                        entries.append(('d', d.name, 0))
-                for f in files:
+    def resolve_sig_target(self, requested_path):
+        """__sig__ の path パラメータを実パスに変換（ルート外を指す場合は None）"""
+        # ブラウザの pathname（例: "/foo/bar.md" や "/foo/"）を想定
+        p = (requested_path or '').split('?', 1)[0]
+        return self.resolve_local_path(urllib.parse.unquote(p))
+
+    def resolve_local_path(self, path_str, always_resolve=False):
+        """
+        デコード済みのURLパスをルートディレクトリ配下の実パスに変換する（ルート外を指す場合は None）。
+        リクエストのたびに realpath しないよう、".." や絶対パスを含む場合のみ解決して検査する。
+        always_resolve が真なら常に解決して検査する（シンボリックリンクでの書き込み先の逸脱も防ぐ）。
+        """
+        p = path_str.lstrip('/')
+        base_dir = self.get_base_dir()
+        target = (base_dir / p) if p else base_dir
+
+        rel = Path(p)
+        if always_resolve or '..' in rel.parts or rel.anchor:
+            try:
+                target_resolved = target.resolve()
+                target_resolved.relative_to(base_dir)
+            except (OSError, ValueError):
+                return None
+            return target_resolved
+        return target
+
+    @staticmethod
+    def compute_sig(target):
+        """対象の (種別, シグネチャ) を返す（存在しなければ None）"""
+        if target.is_dir():
+            # ディレクトリ一覧に影響するもの（直下のディレクトリ + .md ファイル）でシグネチャ生成
+            # 変更検知にしか使わないため、エントリごとの crc32 を加算して並び順に依存しない値にし、
+            # 一覧の構築・ソートと暗号学的ハッシュを省く
+            try:
+                dir_mtime_ns = target.stat().st_mtime_ns
+            except Exception:
+                dir_mtime_ns = 0
+            count = 0
+            total = 0
+            # os.scandir の DirEntry は種別判定に readdir の結果を使い、stat() もキャッシュする
+            with os.scandir(target) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        kind = b'd'
+                    elif entry.is_file() and _is_markdown_name(entry.name):
+                        kind = b'f'
+                    else:
+                        continue
                     try:
-                        entries.append(('f', f.name, f.stat().st_mtime_ns))
+                        mtime_ns = entry.stat().st_mtime_ns
                     except Exception:
-                        entries.append(('f', f.name, 0))
+                        mtime_ns = 0
+                    name = entry.name.encode('utf-8', errors='replace')
+                    total += zlib.crc32(b'%s\0%s\0%d' % (kind, name, mtime_ns))
+                    count += 1
 
-                entries.sort(key=lambda x: x[1].lower())
-                h = hashlib.sha1()
-                try:
-                    h.update(b'DIR\0')
-                    h.update(str(target_resolved.stat().st_mtime_ns).encode('ascii', errors='ignore'))
-                    h.update(b'\n')
-                except Exception:
-                    pass
-                for kind, name, mtime_ns in entries:
-                    h.update(kind.encode('ascii', errors='ignore'))
-                    h.update(b'\0')
-                    h.update(name.encode('utf-8', errors='replace'))
-                    h.update(b'\0')
-                    h.update(str(mtime_ns).encode('ascii', errors='ignore'))
-                    h.update(b'\n')
-
-                self._send_json({'exists': True, 'kind': 'dir', 'sig': h.hexdigest()})
-                return
+            return 'dir', f'{dir_mtime_ns:x}-{count:x}-{total:x}'
 
-            if target_resolved.is_file():
-                try:
-                    sig = str(target_resolved.stat().st_mtime_ns)
-                except Exception:
-                    sig = '0'
-                self._send_json({'exists': True, 'kind': 'file', 'sig': sig})
-                return
+        if target.is_file():
+            try:
+                sig = str(target.stat().st_mtime_ns)
+            except Exception:
+                sig = '0'
+            return 'file', sig
 
-            self._send_json({'exists': False})
-        except Exception as e:
-            self._send_json({'exists': False, 'error': str(e)})
+        return None
     
-    def _send_json(self, data):
-        """JSONレスポンスを送信"""
+    @classmethod
+    def get_base_dir(cls):
+        """ルートディレクトリの絶対パスを返す（resolve() は一度だけ行う）"""
+        if cls.base_dir_resolved is None:
+            cls.base_dir_resolved = Path('.').resolve()
+        return cls.base_dir_resolved
+
+    @staticmethod
+    def _sig_etag(kind, sig):
+        """シグネチャから __sig__ 応答のETagを作る"""
+        return f'"{kind}-{sig}"'
+
+    def _send_sig(self, kind, sig):
+        """シグネチャを返す（ETagが If-None-Match と一致すれば304でボディを省略）"""
+        etag = self._sig_etag(kind, sig)
+        if self._etag_matches(etag):
+            self._send_not_modified(etag)
+            return
+        self._send_json({'exists': True, 'kind': kind, 'sig': sig}, etag=etag)
+
+    def _if_none_match_tags(self):
+        """If-None-Match ヘッダーのETagの一覧を返す（未指定なら空）"""
+        header = self.headers.get('If-None-Match')
+        if not header:
+            return []
+        return [t.strip() for t in header.split(',')]
+
+    def _etag_matches(self, etag):
+        """If-None-Match ヘッダーが指定のETagに一致するか"""
+        tags = self._if_none_match_tags()
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    def _send_not_modified(self, etag, cache_control='no-cache'):
+        """304 Not Modified を送信"""
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
+    def _send_json(self, data, etag=None):
+        """JSONレスポンスを送信（etag指定時は再検証前提でキャッシュを許可）"""
         import json
         response = json.dumps(data, ensure_ascii=False)
         self.send_response(200)
         self.send_header('Content-Type', 'application/json; charset=utf-8')
-        self.send_no_cache_headers()
-        self.end_headers()
-        self.wfile.write(response.encode('utf-8'))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        else:
+            self.send_no_cache_headers()
+        self.end_headers_with_body(response.encode('utf-8'))
+
+    def end_headers_with_body(self, body):
+        """ヘッダーとボディを1回の write で送信（__sig__ 等の小さなレスポンスの send 回数を減らす）"""
+        self.send_header('Content-Length', str(len(body)))
+        if self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append(b'\r\n')
+            self._headers_buffer.append(body)
+            self.flush_headers()
+        else:
+            self.wfile.write(body)
+    
+    def end_headers_with_chunks(self, chunks):
+        """ヘッダーと複数のバイト列のボディを、連結せずに1回の sendmsg でまとめて送信"""
+        self.send_header('Content-Length', str(sum(len(chunk) for chunk in chunks)))
+        if self.request_version != 'HTTP/0.9':
+            self._headers_buffer.append(b'\r\n')
+            headers = b''.join(self._headers_buffer)
+            self._headers_buffer = []
+            self.write_chunks((headers, *chunks))
+        else:
+            self.write_chunks(chunks)
     
     def send_directory_listing(self, dir_path):
         """指定されたディレクトリ直下のファイルとフォルダを表示"""
         try:
-            rel_path = dir_path.relative_to(Path('.'))
+            rel_path = dir_path.relative_to(self.get_base_dir())
         except ValueError:
             rel_path = Path('.')
             
         # ルートの場合はベースディレクトリ名を表示、それ以外は相対パスを表示
-        if str(rel_path) == '.':
+        is_root = str(rel_path) == '.'
+        if is_root:
             display_path = self.base_dir_name if self.base_dir_name else '/'
+            # 各エントリのリンクは「このディレクトリのURL + 名前」になる
+            link_prefix = '/'
         else:
             # パスデリミタを / で統一
-            display_path = self.base_dir_name + '/' + str(rel_path).replace('\\', '/')
+            rel_posix = rel_path.as_posix()
+            display_path = self.base_dir_name + '/' + rel_posix
+            link_prefix = '/' + rel_posix + '/'
         
-        items = list(dir_path.iterdir())
-        
-        # フォルダとファイルを分離、更新日時の新しい順にソート
-        dirs = [d for d in items if d.is_dir()]
-        dirs.sort(key=lambda d: d.stat().st_mtime, reverse=True)
-        
-        files = [f for f in items if f.is_file() and f.suffix.lower() == '.md']
-        files.sort(key=lambda f: f.stat().st_mtime, reverse=True)
+        # フォルダとファイルを1回の走査で分離し、更新日時の新しい順にソート
+        # os.scandir の DirEntry は種別判定に readdir の結果を使い、stat() もキャッシュする
+        # 更新日時はエントリごとに一度だけ取得し、(エントリ, 更新日時) の組で並べ替える
+        dirs = []
+        files = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append((entry, entry.stat().st_mtime))
+                # 拡張子の判定を先に行い、.md 以外では種別判定（シンボリックリンク等での stat）もしない
+                elif _is_markdown_name(entry.name) and entry.is_file():
+                    files.append((entry, entry.stat().st_mtime))
+        dirs.sort(key=itemgetter(1), reverse=True)
+        files.sort(key=itemgetter(1), reverse=True)
 
-        content = f'<div class="file-list"><h1>📂 {display_path}</h1>'
+        # 件数が多いディレクトリでも文字列連結が二乗にならないよう、リストに溜めて最後に結合する
+        parts = [f'<div class="file-list"><h1>📂 {display_path}</h1>']
         
         # 「一つ上へ」のリンク（ルート以外の場合）
-        if str(rel_path) != '.':
-            parent_link = '/' if str(rel_path.parent) == '.' else '/' + str(rel_path.parent).replace('\\', '/') + '/'
-            content += f'<a class="file-item dir-link" href="{parent_link}">⬆️ 一つ上の階層へ</a>'
+        if not is_root:
+            parent_link = '/' if str(rel_path.parent) == '.' else '/' + rel_path.parent.as_posix() + '/'
+            parts.append(f'<a class="file-item dir-link" href="{parent_link}">⬆️ 一つ上の階層へ</a>')
 
         if not dirs and not files:
-            content += '<p>表示できるファイルやフォルダがありません。</p>'
+            parts.append('<p>表示できるファイルやフォルダがありません。</p>')
         else:
-            # フォルダを表示
-            for d in dirs:
-                # リンクは常に末尾に / をつける
-                try:
-                    d_rel = d.relative_to(Path('.'))
-                    d_rel_str = str(d_rel).replace('\\', '/')
-                    content += f'<a class="file-item dir-link" href="/{d_rel_str}/">📁 {d.name}/</a>'
-                except ValueError:
-                    continue
+            # エントリはすべて dir_path 直下なので、相対パスはエントリごとに Path を作らず名前を連結して得る
+            # フォルダを表示（リンクは常に末尾に / をつける）
+            for d, _ in dirs:
+                parts.append(f'<a class="file-item dir-link" href="{link_prefix}{d.name}/">📁 {d.name}/</a>')
             
             # ファイルを表示
-            for f in files:
-                try:
-                    f_rel = f.relative_to(Path('.'))
-                    f_rel_str = str(f_rel).replace('\\', '/')
-                    content += f'<a class="file-item" href="/{f_rel_str}">📝 {f.name}</a>'
-                except ValueError:
-                    continue
+            for f, _ in files:
+                parts.append(f'<a class="file-item" href="{link_prefix}{f.name}">📝 {f.name}</a>')
         
-        content += '</div>'
+        parts.append('</div>')
+        content = ''.join(parts)
         
         # ルートディレクトリのみ設定ボタンを表示
-        is_root = str(rel_path) == '.'
-        settings_section = SETTINGS_SECTION_HTML if is_root else ''
+        settings_section = SETTINGS_SECTION_BYTES if is_root else b''
         
-        html_output = HTML_TEMPLATE.format(
+        # 事前にエンコード済みのテンプレート断片と差し込み値を、連結せずにそのまま送る
+        body = render_template_chunks(
+            HTML_TEMPLATE_PARTS,
             title=f'Index of {display_path}',
             content=content,
             settings_section=settings_section
@@ -413,125 +702,296 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Content-Type', 'text/html; charset=utf-8')
         self.send_no_cache_headers()
-        self.end_headers()
-        self.wfile.write(html_output.encode('utf-8'))
+        self.end_headers_with_chunks(body)
     
-    def send_markdown_as_html(self, file_path):
-        """MarkdownファイルをHTMLに変換して送信"""
+    def send_markdown_as_html(self, file_path, st=None):
+        """MarkdownファイルをHTMLに変換して送信（st には呼び出し元で取得済みの stat 結果を渡せる）"""
         try:
-            # ファイルのエンコーディングを自動検出して読み込み
-            # utf-8-sig を先に試行してBOM付きUTF-8を正しく処理する
-            encodings_to_try = ['utf-8-sig', 'utf-8', 'shift_jis', 'cp932', 'euc-jp', 'iso-2022-jp', 'latin-1']
-            md_content = None
-            used_encoding = None
-            
-            for encoding in encodings_to_try:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        md_content = f.read()
-                    used_encoding = encoding
-                    break
-                except (UnicodeDecodeError, LookupError):
-                    continue
-            
-            if md_content is None:
-                # どのエンコーディングでも読めなかった場合は、バイナリモードで読み込んでエラー文字を置換
-                with open(file_path, 'rb') as f:
-                    raw_data = f.read()
-                md_content = raw_data.decode('utf-8', errors='replace')
-                used_encoding = 'utf-8 (with errors replaced)'
-            
-            # Mermaidブロックを一時的にプレースホルダーに置換
-            mermaid_blocks = []
-            def save_mermaid(match):
-                mermaid_blocks.append(match.group(1))
-                return f'<!--MERMAID_PLACEHOLDER_{len(mermaid_blocks) - 1}-->'
-            
-            # ```mermaid ... ``` ブロックを抽出
-            md_content = re.sub(
-                r'```mermaid\s*\n(.*?)```',
-                save_mermaid,
-                md_content,
-                flags=re.DOTALL
-            )
-            
-            # 強制改ページマーカー: 行頭から8つ以上のハイフンのみの行を検出
-            # 印刷時にpage-breakとして機能するdivに変換
-            # 注: markdownは ---（3つ以上）を<hr>に変換するため、
-            #     8つ以上のハイフンをHTMLコメント形式のプレースホルダーに置換
-            #     （___はMarkdownで斜体として解釈されるため使用不可）
-            md_content = re.sub(
-                r'^-{8,}$',
-                '<!--PAGEBREAK8-->',
-                md_content,
-                flags=re.MULTILINE
-            )
-            
-            if MARKDOWN_AVAILABLE:
-                # markdown パッケージを使用
-                # 拡張機能をインスタンスとして直接渡すことで、entry_points.txt の検索を回避
-                # （暗号化環境等でentry_points.txtが読めない場合の対策）
-                extensions = [
-                    FencedCodeExtension(),
-                    TableExtension(),
-                    TocExtension(slugify=githubish_slugify, separator='-'),
-                    CodeHiliteExtension(),
-                    Nl2BrExtension(),
-                    SaneListExtension(),
-                    AttrListExtension()
-                ]
-                # pymdownx.tildeもインスタンスとして追加（インストールされている場合のみ）
-                try:
-                    from pymdownx.tilde import DeleteSubExtension
-                    extensions.append(DeleteSubExtension())
-                except ImportError:
-                    pass  # pymdownxがインストールされていない場合は無視
-                
-                html_content = markdown.markdown(
-                    md_content,
-                    extensions=extensions
-                )
-            else:
-                # フォールバック: HTML変換
-                html_content = self.simple_markdown_to_html(md_content)
-            
-            # Mermaidブロックを復元（<pre class="mermaid">形式で）
-            # HTMLエスケープにより <br/> 等のHTMLタグがブラウザに解釈されるのを防ぐ
-            # mermaid.jsはtextContentで読み取るため、エスケープされた文字は自動的に復元される
-            for i, block in enumerate(mermaid_blocks):
-                html_content = html_content.replace(
-                    f'<!--MERMAID_PLACEHOLDER_{i}-->',
-                    f'<pre class="mermaid">{html.escape(block)}</pre>'
-                )
-            
-            # 強制改ページマーカーを復元
-            # markdownライブラリが<p>タグで囲む場合があるため、両方のパターンを処理
-            html_content = html_content.replace(
-                '<p><!--PAGEBREAK8--></p>',
-                '<div class="page-break"></div>'
-            )
-            html_content = html_content.replace(
-                '<!--PAGEBREAK8-->',
-                '<div class="page-break"></div>'
-            )
-            
-            # 見出しIDは markdown.extensions.toc が付与する（extension_configsでslugifyを調整）
-            
-            html_output = self.get_html_template().format(
-                title=file_path.name,
-                content=html_content,
-                header_mode='true' if self.header_mode else 'false'
-            )
-            
+            # ファイルが更新されていなければ、読み込まずにキャッシュ済みのHTMLを返す
+            resolved = file_path.resolve()
+            if st is None:
+                st = file_path.stat()
+            entry = self._get_cached_page(self._render_cache_key(resolved, st))
+            if entry is None:
+                raw = file_path.read_bytes()
+                cache_key = (str(resolved), hashlib.blake2b(raw, digest_size=16).digest())
+                with self._render_cache_lock:
+                    self._source_states.pop(cache_key[0], None)
+                    self._source_states[cache_key[0]] = (st.st_mtime_ns, st.st_size, cache_key[1])
+                    # 古いものから捨て、キャッシュの上限に見合う件数に抑える
+                    while len(self._source_states) > self.render_cache_size:
+                        del self._source_states[next(iter(self._source_states))]
+                # 更新日時だけが変わり内容が同じなら、前回の変換結果をそのまま使う
+                entry = self._get_cached_page(cache_key)
+                if entry is None:
+                    chunks = self.render_markdown_page(file_path, raw)
+                    # gzip 圧縮は変換時に一度だけ行い、非圧縮のチャンクと組でキャッシュする
+                    entry = (chunks, self.gzip_chunks(chunks, self.gzip_level))
+                    self._store_cached_page(cache_key, entry)
+
+            body, gzipped = self._select_page_body(entry)
             self.send_response(200)
             self.send_header('Content-Type', 'text/html; charset=utf-8')
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
             self.send_no_cache_headers()
-            self.end_headers()
-            self.wfile.write(html_output.encode('utf-8'))
-            
+            self.end_headers_with_chunks(body)
+
         except Exception as e:
             self.send_error(500, f'Error: {str(e)}')
 
+    @classmethod
+    def _render_cache_key(cls, resolved, st):
+        """前回読み込んだときから更新日時・サイズが変わっていなければキャッシュのキーを返す（変わっていれば None）"""
+        path = str(resolved)
+        with cls._render_cache_lock:
+            state = cls._source_states.get(path)
+        # mtime の分解能が粗いファイルシステム（FAT、ネットワーク共有等）では同一時刻内の
+        # 書き換えを見逃しうるため、サイズも比較する
+        if state is None or state[0] != st.st_mtime_ns or state[1] != st.st_size:
+            return None
+        return (path, state[2])
+
+    @classmethod
+    def _get_cached_page(cls, cache_key):
+        """キャッシュ済みの (HTMLチャンクのタプル, gzip圧縮済みバイト列) を返す（無ければ None）"""
+        with cls._render_cache_lock:
+            entry = cls._render_cache.get(cache_key)
+            if entry is not None:
+                cls._render_cache.move_to_end(cache_key)
+        return entry
+
+    @classmethod
+    def _store_cached_page(cls, cache_key, body):
+        """変換済みHTMLをキャッシュに格納し、上限を超えた古いものから捨てる"""
+        with cls._render_cache_lock:
+            cls._render_cache[cache_key] = body
+            while len(cls._render_cache) > cls.render_cache_size:
+                cls._render_cache.popitem(last=False)
+
+    def _select_page_body(self, entry):
+        """キャッシュエントリからクライアントに送るチャンク列と、gzip で送るかどうかを選ぶ"""
+        chunks, gzipped = entry
+        if self.accepts_gzip():
+            return (gzipped,), True
+        return chunks, False
+
+    def accepts_gzip(self):
+        """Accept-Encoding で gzip を受け付けているか（q=0 で明示的に拒否されている場合を除く）"""
+        accept = self.headers.get('Accept-Encoding', '')
+        for item in accept.lower().split(','):
+            coding, _, params = item.partition(';')
+            if coding.strip() in ('gzip', '*'):
+                _, has_q, q = params.replace(' ', '').partition('q=')
+                try:
+                    return not has_q or float(q) > 0
+                except ValueError:
+                    return False
+        return False
+
+    @staticmethod
+    def gzip_chunks(chunks, level):
+        """複数のバイト列を連結せずに順に gzip 圧縮する"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: gzip 形式
+        out = [compressor.compress(chunk) for chunk in chunks]
+        out.append(compressor.flush())
+        return b''.join(out)
+
+    def write_chunks(self, chunks):
+        """複数のバイト列を連結せずに送信（sendmsg が使える環境では1回のシステムコールでまとめて送る）"""
+        sendmsg = getattr(self.connection, 'sendmsg', None)
+        if sendmsg is None:
+            # Windows等: 連結して1回で書き込む
+            self.wfile.write(b''.join(chunks))
+            return
+        views = [memoryview(chunk) for chunk in chunks if chunk]
+        # 送信済みのチャンクはリストから取り除かず、先頭の位置を進める
+        start = 0
+        while start < len(views):
+            # 1回に渡すバッファ数は IOV_MAX まで（超えると EMSGSIZE になる）
+            sent = sendmsg(views[start:start + _IOV_MAX])
+            # 送信し終えたチャンクを飛ばし、途中まで送れたチャンクは残りだけにする
+            while start < len(views) and sent >= len(views[start]):
+                sent -= len(views[start])
+                start += 1
+            if sent:
+                views[start] = views[start][sent:]
+
+    def render_markdown_page(self, file_path, raw=None):
+        """MarkdownファイルをHTMLページに変換し、UTF-8バイト列のタプル（連結前のチャンク）で返す"""
+        # ファイルを一度だけ読み込み（読み込み済みの内容があればそれを使い）、エンコーディングを自動検出してデコード
+        if raw is None:
+            raw = file_path.read_bytes()
+        md_content = self.decode_markdown_bytes(raw)
+        
+        # Mermaidブロックを一時的にプレースホルダーに置換
+        mermaid_blocks = []
+        def save_mermaid(match):
+            mermaid_blocks.append(match.group(1))
+            return f'<!--MERMAID_PLACEHOLDER_{len(mermaid_blocks) - 1}-->'
+        
+        # ```mermaid ... ``` ブロックを抽出（含まれない大半のファイルでは正規表現を走らせない）
+        if '```mermaid' in md_content:
+            md_content = self._MERMAID_BLOCK_PATTERN.sub(save_mermaid, md_content)
+        
+        # 強制改ページマーカー: 行頭から8つ以上のハイフンのみの行を検出
+        # 印刷時にpage-breakとして機能するdivに変換
+        # 注: markdownは ---（3つ以上）を<hr>に変換するため、
+        #     8つ以上のハイフンをHTMLコメント形式のプレースホルダーに置換
+        #     （___はMarkdownで斜体として解釈されるため使用不可）
+        # 8連続のハイフンが無ければマーカーも無いので、置換・復元ともに省略する
+        has_pagebreak = '--------' in md_content
+        if has_pagebreak:
+            md_content = self._PAGEBREAK_PATTERN.sub('<!--PAGEBREAK8-->', md_content)
+        
+        if MARKDOWN_AVAILABLE:
+            # markdown パッケージを使用
+            html_content, toc_tokens = self.convert_markdown(md_content)
+        else:
+            # フォールバック: HTML変換
+            html_content, toc_tokens = self.simple_markdown_to_html(md_content)
+        # H1の直後にインラインTOCを挿入（ブラウザ側でDOMを組み立てずに済むよう、変換結果と一緒にキャッシュする）
+        toc_html = self.build_inline_toc(toc_tokens)
+        if toc_html:
+            html_content = html_content.replace('</h1>', '</h1>\n' + toc_html, 1)
+        
+        # コードブロックにCopyボタンを付ける（Mermaidはまだプレースホルダーなので対象外）
+        html_content = self.wrap_code_blocks(html_content)
+        
+        # Mermaidブロックと強制改ページマーカーを1回の走査でまとめて復元
+        if mermaid_blocks or has_pagebreak:
+            def restore(match):
+                index = match.group(1)
+                if index is None:
+                    return '<div class="page-break"></div>'
+                index = int(index)
+                if index >= len(mermaid_blocks):
+                    return match.group(0)
+                # Mermaidブロックは <pre class="mermaid"> 形式で復元
+                # HTMLエスケープにより <br/> 等のHTMLタグがブラウザに解釈されるのを防ぐ
+                # mermaid.jsはtextContentで読み取るため、エスケープされた文字は自動的に復元される
+                return f'<pre class="mermaid">{html.escape(mermaid_blocks[index])}</pre>'
+            
+            html_content = self._PLACEHOLDER_PATTERN.sub(restore, html_content)
+        
+        # 見出しIDは markdown.extensions.toc が付与する（extension_configsでslugifyを調整）
+        
+        return tuple(render_template_chunks(
+            self.get_html_template_parts(),
+            title=file_path.name,
+            content=html_content,
+            header_mode='true' if self.header_mode else 'false'
+        ))
+
+    @classmethod
+    def decode_markdown_bytes(cls, raw):
+        """Markdownファイルのバイト列をエンコーディングを判定してデコード"""
+        try:
+            # 大半を占めるUTF-8（BOM付きを含む）はそのままデコード
+            md_content = raw.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            md_content = None
+            if CHARSET_NORMALIZER_AVAILABLE:
+                # 候補を従来のエンコーディングに限定して1回で判定する
+                # （候補を絞らないと短い日本語の文章を別の文字コードと誤判定しやすい）
+                best = charset_normalizer.from_bytes(
+                    raw, cp_isolation=list(cls._FALLBACK_ENCODINGS)
+                ).best()
+                if best is not None:
+                    md_content = str(best)
+            if md_content is None:
+                for encoding in cls._FALLBACK_ENCODINGS:
+                    try:
+                        md_content = raw.decode(encoding)
+                        break
+                    except (UnicodeDecodeError, LookupError):
+                        continue
+                else:
+                    # どのエンコーディングでも読めなかった場合は、エラー文字を置換
+                    md_content = raw.decode('utf-8', errors='replace')
+        # テキストモードで読み込んでいた時と同様に改行を \n に統一する
+        return md_content.replace('\r\n', '\n').replace('\r', '\n')
+
+    @classmethod
+    def prepare_markdown(cls):
+        """Markdownインスタンスを1つ構築しておく（サーバー起動時に呼び、初回リクエストの構築待ちをなくす）"""
+        with cls._markdown_lock:
+            if not cls._markdown_pool:
+                cls._markdown_pool.append(cls.build_markdown())
+
+    @classmethod
+    def convert_markdown(cls, md_content):
+        """プールのMarkdownインスタンスで変換し、(HTML, 見出しの toc_tokens) を返す（拡張機能の構築は同時に変換する数の分だけ）"""
+        # Markdownインスタンスはスレッドセーフではないため、変換中はプールから取り出して占有する
+        with cls._markdown_lock:
+            md = cls._markdown_pool.pop() if cls._markdown_pool else None
+        if md is None:
+            md = cls.build_markdown()
+        try:
+            return md.reset().convert(md_content), md.toc_tokens
+        finally:
+            with cls._markdown_lock:
+                cls._markdown_pool.append(md)
+
+    @classmethod
+    def wrap_code_blocks(cls, html_content):
+        """<pre> のコードブロックを Copy ボタン付きの .mdf2h-codewrap で囲む（中身が空のものは除く）"""
+        if '<pre' not in html_content:
+            return html_content
+        
+        def wrap(match):
+            block = match.group(0)
+            # HTMLとして直接書かれた <pre class="mermaid"> は囲まない
+            if 'mermaid' in block[:block.index('>')]:
+                return block
+            if not cls._HTML_TAG_PATTERN.sub('', block).strip():
+                return block
+            return f'<div class="mdf2h-codewrap">{CODE_COPY_BUTTON_HTML}{block}</div>'
+        
+        return cls._PRE_BLOCK_PATTERN.sub(wrap, html_content)
+
+    @classmethod
+    def build_inline_toc(cls, toc_tokens):
+        """toc_tokens からインラインTOC（H2〜H4）のHTMLを組み立てる（対象の見出しが無ければ空文字）"""
+        items = []
+        top_level = None
+        # 文書順（前順）にたどる
+        stack = list(reversed(toc_tokens))
+        while stack:
+            token = stack.pop()
+            stack.extend(reversed(token['children']))
+            level = token['level']
+            # name はHTMLエスケープ済みのテキスト
+            if not 2 <= level <= 4 or html.unescape(token['name']) in cls._INLINE_TOC_SKIP_NAMES:
+                continue
+            if top_level is None or level < top_level:
+                top_level = level
+            li_class = '' if level == 2 else f' class="toc-level-h{level}"'
+            items.append(f'<li{li_class}><a href="#{html.escape(token["id"])}">{token["name"]}</a></li>')
+        if not items:
+            return ''
+        return f'<nav class="mdf2h-inline-toc" data-top-level="{top_level}"><ul>{"".join(items)}</ul></nav>'
+
+    @staticmethod
+    def build_markdown():
+        """変換に使用するMarkdownインスタンスを構築"""
+        # 拡張機能をインスタンスとして直接渡すことで、entry_points.txt の検索を回避
+        # （暗号化環境等でentry_points.txtが読めない場合の対策）
+        extensions = [
+            FencedCodeExtension(),
+            TableExtension(),
+            TocExtension(slugify=githubish_slugify, separator='-'),
+            CodeHiliteExtension(),
+            Nl2BrExtension(),
+            SaneListExtension(),
+            AttrListExtension()
+        ]
+        # pymdownx.tildeもインスタンスとして追加（インストールされている場合のみ）
+        if PYMDOWNX_AVAILABLE:
+            extensions.append(DeleteSubExtension())
+        return markdown.Markdown(extensions=extensions)
+
     def send_no_cache_headers(self):
         """キャッシュされないようHTTPヘッダーを追加"""
         self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
@@ -540,54 +1000,75 @@ class PrettyMarkdownHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     
     def get_html_template(self):
         """HTMLテンプレートを返す（Ctrl+P印刷対応）"""
-        return get_print_html_template()
+        return PRINT_HTML_TEMPLATE
+
+    def get_html_template_parts(self):
+        """事前に分解したHTMLテンプレートを返す（render_template_chunks() 用）"""
+        return PRINT_HTML_TEMPLATE_PARTS
     
-    @staticmethod
-    def simple_markdown_to_html(md_content):
-        """Markdown→HTML変換"""
-        def apply_strikethrough(text):
-            return re.sub(r'~~(.*?)~~', r'<del>\1</del>', text)
+    @classmethod
+    def simple_markdown_to_html(cls, md_content):
+        """Markdown→HTML変換し、(HTML, インラインTOC用の toc_tokens) を返す（見出しは階層化しない）"""
+        match_block = cls._FALLBACK_BLOCK_PATTERN.match
+        block_tags = cls._FALLBACK_BLOCK_TAGS
 
-        lines = md_content.split('\n')
         html_lines = []
+        append = html_lines.append
         in_code_block = False
-        code_lang = ''
+        # コードブロックの中身（閉じたときにまとめてエスケープする）
+        code_lines = []
+        # H2〜H4 の見出し（TOCのリンク先になるよう、文書順の連番で id を振る）
+        toc_tokens = []
 
-        for line in lines:
+        for line in md_content.splitlines():
             # 先頭の空白を無視して判定（インデント付き ``` などにも対応）
             stripped = line.lstrip()
             # コードブロック
             if stripped.startswith('```'):
                 if not in_code_block:
                     code_lang = stripped[3:].strip()
-                    html_lines.append(f'<pre><code class="language-{code_lang}">')
+                    append(f'<pre><code class="language-{code_lang}">')
                     in_code_block = True
                 else:
-                    html_lines.append('</code></pre>')
+                    if code_lines:
+                        append(html.escape('\n'.join(code_lines), quote=False))
+                        code_lines.clear()
+                    append('</code></pre>')
                     in_code_block = False
                 continue
             
             if in_code_block:
-                html_lines.append(line.replace('<', '&lt;').replace('>', '&gt;'))
+                code_lines.append(line)
                 continue
             
-            # 見出し
-            if stripped.startswith('#### '):
-                html_lines.append(f'<h4>{apply_strikethrough(stripped[5:])}</h4>')
-            elif stripped.startswith('### '):
-                html_lines.append(f'<h3>{apply_strikethrough(stripped[4:])}</h3>')
-            elif stripped.startswith('## '):
-                html_lines.append(f'<h2>{apply_strikethrough(stripped[3:])}</h2>')
-            elif stripped.startswith('# '):
-                html_lines.append(f'<h1>{apply_strikethrough(stripped[2:])}</h1>')
-            # リスト
-            elif stripped.startswith('- ') or stripped.startswith('* '):
-                html_lines.append(f'<li>{apply_strikethrough(stripped[2:])}</li>')
             # 空行
-            elif line.strip() == '':
-                html_lines.append('<br>')
+            if not stripped:
+                append('<br>')
+                continue
+            
+            # 見出し（# ～ ####）・リスト（- / *）は1回のマッチで判定
+            m = match_block(stripped)
+            if m:
+                tag = block_tags[m.group(1)]
+                text = m.group(2)
+                if tag in ('h2', 'h3', 'h4'):
+                    heading_id = f'toc-{tag}-{len(toc_tokens)}'
+                    toc_tokens.append({
+                        'level': int(tag[1]),
+                        'id': heading_id,
+                        # markdown の toc_tokens と同じく、HTMLエスケープ済みのテキスト
+                        'name': html.escape(text.replace('~~', ''), quote=False),
+                        'children': [],
+                    })
+                    append(f'<{tag} id="{heading_id}">{_apply_strikethrough(text)}</{tag}>')
+                else:
+                    append(f'<{tag}>{_apply_strikethrough(text)}</{tag}>')
             # 通常のテキスト
             else:
-                html_lines.append(f'<p>{apply_strikethrough(line)}</p>')
+                append(f'<p>{_apply_strikethrough(line)}</p>')
+        
+        # 閉じられていないコードブロックの中身
+        if code_lines:
+            append(html.escape('\n'.join(code_lines), quote=False))
         
-        return '\n'.join(html_lines)
+        return '\n'.join(html_lines), toc_tokens
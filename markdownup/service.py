@@ -7,38 +7,87 @@ import signal
 from pathlib import Path
 
 from .constants import (
-    DEFAULT_PORT, FALLBACK_PORTS,
+    DEFAULT_PORT, FALLBACK_PORTS, IS_WINDOWS,
     PID_BASE_DIR, PID_INSTANCES_DIR, LATEST_PID_FILE
 )
 from .utils import resolve_target_directory
 
+# 書き込んだPIDファイル（Linux/macOSではロックを保持したまま、プロセスの終了まで開いておく）
+_pid_file_handle = None
+
+
+def _replace_with_text(path, text, keep_locked=False):
+    """
+    一時ファイルに書き込んでから rename で置き換える（読み手が書きかけの内容を読まないようにする）。
+    keep_locked が真の場合、Linux/macOSではロックを取ったファイルを開いたまま返す（それ以外は None）。
+    """
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    f = open(tmp_path, 'w', encoding='utf-8')
+    try:
+        f.write(text)
+        f.flush()
+        if keep_locked and not IS_WINDOWS:
+            # ロックは置き換え後も同じファイル（inode）に付いたまま残る
+            import fcntl
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                pass
+        else:
+            # Windowsでは開いたままだと置き換え・削除ができないため閉じる
+            f.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        f.close()
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        raise
+    return None if f.closed else f
+
 
 def save_pid(port):
     """PIDファイルにプロセスIDを保存し、最新のポートを記録"""
+    global _pid_file_handle
     try:
         PID_INSTANCES_DIR.mkdir(parents=True, exist_ok=True)
         # ポートごとのPIDファイル
+        # Linux/macOS: ロックを保持しておき、--stop 側でこのプロセスが生きているかを確かめられるようにする
+        # （プロセスが終了するとロックは自動的に解放される）
         pid_file = PID_INSTANCES_DIR / f'port_{port}.pid'
-        with open(pid_file, 'w', encoding='utf-8') as f:
-            f.write(str(os.getpid()))
-        # 最新のポート番号を記録
-        with open(LATEST_PID_FILE, 'w', encoding='utf-8') as f:
-            f.write(str(port))
+        _pid_file_handle = _replace_with_text(pid_file, str(os.getpid()), keep_locked=True)
+        # 最新のポート番号を記録（--start 側が起動直後に読むため、書きかけを読ませない）
+        _replace_with_text(LATEST_PID_FILE, str(port))
     except Exception as e:
         print(f"[!] PIDファイルの保存に失敗しました: {e}")
 
 
 def remove_pid(port):
     """指定されたポートのPIDファイルを削除"""
+    global _pid_file_handle
     try:
+        if _pid_file_handle is not None:
+            _pid_file_handle.close()
+            _pid_file_handle = None
         pid_file = PID_INSTANCES_DIR / f'port_{port}.pid'
         if pid_file.exists():
             pid_file.unlink()
         
         # 全てのPIDファイルがなくなったら最新ポート記録も消す
-        if not any(PID_INSTANCES_DIR.glob('port_*.pid')):
-            if LATEST_PID_FILE.exists():
-                LATEST_PID_FILE.unlink()
+        # （名前だけ見ればよいので、Pathを作らない scandir で1つ見つかった時点で打ち切る）
+        has_other_pid = False
+        try:
+            with os.scandir(PID_INSTANCES_DIR) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith('port_') and name.endswith('.pid'):
+                        has_other_pid = True
+                        break
+        except FileNotFoundError:
+            pass
+        if not has_other_pid and LATEST_PID_FILE.exists():
+            LATEST_PID_FILE.unlink()
     except Exception as e:
         print(f"[!] PIDファイルの削除に失敗しました: {e}")
 
@@ -73,11 +122,92 @@ def read_pid(port=None):
     return None, None
 
 
-def get_pid_using_port(port):
-    """指定ポートをLISTENしているプロセスのPIDを取得（Windows/Linux対応）"""
+def _listening_socket_inodes(ports):
+    """
+    /proc/net/tcp, /proc/net/tcp6 から指定ポートをLISTENしているソケットを集める（Linux用）。
+    inode -> ポート の辞書を返す。
+    """
+    inodes = {}
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table, 'rb') as f:
+                next(f, None)  # ヘッダー行
+                for line in f:
+                    # "sl local_address rem_address st ... inode"
+                    # local_address は "16進IP:16進ポート"、st の 0A が LISTEN
+                    fields = line.split()
+                    if len(fields) < 10 or fields[3] != b'0A':
+                        continue
+                    port = int(fields[1].rsplit(b':', 1)[1], 16)
+                    if port in ports:
+                        inodes[int(fields[9])] = port
+        except (OSError, ValueError, IndexError):
+            continue
+    return inodes
+
+
+def _find_pids_by_socket_inodes(inodes):
+    """
+    /proc/<pid>/fd のリンク先から、指定inodeのソケットを持つプロセスを探す（Linux用）。
+    inode -> PID の辞書を返す（すべて見つかった時点で走査を打ち切る）。
+    """
+    targets = {f'socket:[{inode}]': inode for inode in inodes}
+    found = {}
+    with os.scandir('/proc') as procs:
+        for proc in procs:
+            if not proc.name.isdigit():
+                continue
+            try:
+                with os.scandir(f'/proc/{proc.name}/fd') as fds:
+                    for fd in fds:
+                        try:
+                            inode = targets.get(os.readlink(fd.path))
+                        except OSError:
+                            continue
+                        if inode is not None and inode not in found:
+                            found[inode] = int(proc.name)
+            except OSError:
+                # 終了済み・他ユーザーのプロセスは参照できない
+                continue
+            if len(found) == len(targets):
+                break
+    return found
+
+
+def _lsof_listening_pids(ports):
+    """lsof で指定ポートをLISTENしているプロセスを調べ、ポート -> PID の辞書を返す"""
     import subprocess
+    # -n -P でホスト名・サービス名の逆引きを省き、-sTCP:LISTEN でLISTEN中のソケットだけに絞る
+    # -F pn で「p<PID>」「n<アドレス:ポート>」の行として出力させ、1回の起動で全ポートを調べる
+    args = ['lsof', '-nP', '-sTCP:LISTEN', '-F', 'pn']
+    for port in ports:
+        args.append(f'-iTCP:{port}')
+    result = subprocess.run(args, capture_output=True, text=True)
+    pids = {}
+    pid = None
+    for line in result.stdout.splitlines():
+        if line.startswith('p'):
+            pid = int(line[1:])
+        elif line.startswith('n') and pid is not None:
+            port_str = line.rsplit(':', 1)[-1]
+            if port_str.isdigit():
+                pids.setdefault(int(port_str), pid)
+    return pids
+
+
+def get_pids_using_ports(ports):
+    """
+    指定ポートそれぞれをLISTENしているプロセスのPIDを取得（Windows/Linux/macOS対応）。
+    ポート -> PID の辞書を返す（LISTENされていないポートは含まない）。
+    netstat / lsof の起動や /proc の走査は、ポートの数によらず1回で済ませる。
+    """
+    ports = set(ports)
+    if not ports:
+        return {}
+    pids = {}
     try:
-        if sys.platform == 'win32':
+        if IS_WINDOWS:
+            import subprocess
             # Windows: netstat -ano
             # Windows日本語環境ではコマンド出力がCP932のため、encoding='oem'で読む
             result = subprocess.run(
@@ -89,63 +219,154 @@ def get_pid_using_port(port):
             )
             for line in result.stdout.split('\n'):
                 # "TCP    0.0.0.0:8000    0.0.0.0:0    LISTENING    12345"
-                # または "TCP    127.0.0.1:8000    ..."
-                if f':{port}' in line and 'LISTENING' in line:
-                    parts = line.split()
-                    if len(parts) >= 5:
-                        return int(parts[-1])
-        else:
-            # Linux/macOS: lsof
-            result = subprocess.run(
-                ['lsof', '-i', f':{port}', '-t'],
-                capture_output=True,
-                text=True
-            )
-            if result.stdout.strip():
-                return int(result.stdout.strip().split('\n')[0])
+                # または "TCP    [::]:8000    [::]:0    LISTENING    12345"
+                if 'LISTENING' not in line:
+                    continue
+                parts = line.split()
+                if len(parts) < 5:
+                    continue
+                port_str = parts[1].rsplit(':', 1)[-1]
+                if port_str.isdigit() and int(port_str) in ports:
+                    pids.setdefault(int(port_str), int(parts[-1]))
+            return pids
+        if sys.platform.startswith('linux') and os.path.exists('/proc/net/tcp'):
+            # Linux: lsof を起動せず /proc から直接調べる
+            inodes = _listening_socket_inodes(ports)
+            for inode, pid in _find_pids_by_socket_inodes(inodes).items():
+                pids.setdefault(inodes[inode], pid)
+            # LISTENはされているが、他ユーザーのプロセス等で fd を辿れなかったポートだけ lsof に任せる
+            ports = {port for port in inodes.values() if port not in pids}
+            if not ports:
+                return pids
+        # macOS（およびLinuxで特定できなかった場合）: lsof
+        for port, pid in _lsof_listening_pids(sorted(ports)).items():
+            pids.setdefault(port, pid)
     except Exception:
         pass
-    return None
+    return pids
+
+
+def get_pid_using_port(port):
+    """指定ポートをLISTENしているプロセスのPIDを取得（Windows/Linux/macOS対応）"""
+    return get_pids_using_ports((port,)).get(port)
+
+
+def _pid_file_owner_exited(pid_file):
+    """
+    PIDファイルを書き込んだプロセスが終了しているかどうか（Linux/macOSのみ判定）。
+    持ち主はロックを保持し続けるため、ロックが取れれば終了している。
+    判定できない場合（Windows等）は False を返す。
+    """
+    if IS_WINDOWS:
+        return False
+    import fcntl
+    try:
+        with open(pid_file, 'rb') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            return True
+    except OSError:
+        return False
+
+
+def _win_terminate_process(pid):
+    """
+    Windows: taskkill を起動せず、OpenProcess + TerminateProcess で直接終了させる。
+    終了させた場合は True、該当するプロセスがない場合は False、
+    権限不足などで終了させられなかった場合は None を返す。
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    PROCESS_TERMINATE = 0x0001
+    ERROR_INVALID_PARAMETER = 87  # 指定したPIDのプロセスが存在しない
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.TerminateProcess.argtypes = (wintypes.HANDLE, wintypes.UINT)
+    kernel32.TerminateProcess.restype = wintypes.BOOL
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+
+    handle = kernel32.OpenProcess(PROCESS_TERMINATE, False, pid)
+    if not handle:
+        return False if ctypes.get_last_error() == ERROR_INVALID_PARAMETER else None
+    try:
+        return True if kernel32.TerminateProcess(handle, 1) else None
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def _terminate_processes(pids):
+    """プロセスをまとめて終了させ、終了できなかった（既に終了していた）PIDの集合を返す"""
+    failed = set()
+    if not pids:
+        return failed
+    if IS_WINDOWS:
+        # Windows: TerminateProcess で直接終了させ、できなかったものだけ taskkill に任せる
+        remaining = []
+        for pid in pids:
+            try:
+                result = _win_terminate_process(pid)
+            except (OSError, AttributeError):
+                result = None
+            if result is None:
+                remaining.append(pid)
+            elif not result:
+                failed.add(pid)
+        if not remaining:
+            return failed
+        import subprocess
+        # taskkill /F で強制終了（確認プロンプトなし）
+        # /PID を並べて1回の起動でまとめて終了させる
+        args = ['taskkill', '/F']
+        for pid in remaining:
+            args += ['/PID', str(pid)]
+        try:
+            subprocess.run(
+                args,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                creationflags=subprocess.CREATE_NO_WINDOW
+            )
+        except OSError:
+            failed.update(remaining)
+    else:
+        # Linux/macOS: signal.SIGTERM
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except (ProcessLookupError, OSError):
+                failed.add(pid)
+    return failed
 
 
 def stop_service():
     """起動中のすべてのサービスを停止"""
-    import subprocess
-    import time
-    
     success_count = 0
-    stopped_ports = set()
+    # PIDファイルから読み取った (PID, ポート) と、ポートのスキャンで見つけた (PID, ポート)
+    pidfile_targets = []
+    scanned_targets = []
+    pid_files_to_remove = []
+    # ロックが取れた（持ち主が終了したと見られる）PIDファイルの (PID, ポート)
+    unlocked_entries = []
     
-    # 1. PIDファイルからプロセスを停止
+    # 1. PIDファイルから停止対象を集める
     if PID_INSTANCES_DIR.exists():
-        pid_files = list(PID_INSTANCES_DIR.glob('port_*.pid'))
-        for pid_file in pid_files:
+        for pid_file in PID_INSTANCES_DIR.glob('port_*.pid'):
             try:
                 port = int(pid_file.stem.split('_')[1])
                 with open(pid_file, 'r', encoding='utf-8') as f:
                     pid = int(f.read().strip())
-                
-                try:
-                    if sys.platform == 'win32':
-                        # Windows: taskkill /F /PID で強制終了（確認プロンプトなし）
-                        subprocess.run(
-                            ['taskkill', '/F', '/PID', str(pid)],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                            creationflags=subprocess.CREATE_NO_WINDOW
-                        )
-                    else:
-                        # Linux/macOS: signal.SIGTERM
-                        os.kill(pid, signal.SIGTERM)
-                    
-                    print(f"[OK] サービスを停止しました (PID: {pid}, ポート: {port})")
-                    success_count += 1
-                    stopped_ports.add(port)
-                except (ProcessLookupError, OSError):
-                    print(f"[!] PID {pid} (ポート: {port}) は既に終了しています")
-                    stopped_ports.add(port)
-                
-                pid_file.unlink()
+                pid_files_to_remove.append(pid_file)
+                if _pid_file_owner_exited(pid_file):
+                    # ロックを取れなかった起動やロック導入前に書かれたPIDファイルもあるため、
+                    # 終了したと決めつけず、記録されたポートをまだ待ち受けているかを後で確かめる
+                    unlocked_entries.append((pid, port))
+                    continue
+                pidfile_targets.append((pid, port))
             except Exception as e:
                 print(f"[ERROR] PIDファイル {pid_file.name} の処理中にエラー: {e}")
                 try:
@@ -153,34 +374,50 @@ def stop_service():
                 except:
                     pass
     
-    if LATEST_PID_FILE.exists():
-        LATEST_PID_FILE.unlink()
-    
-    # 2. 実際にポートを使用しているプロセスをスキャンして停止
-    ports_to_check = [DEFAULT_PORT] + FALLBACK_PORTS
+    # 2. PIDファイルに記録されていないポートを実際に使用しているプロセスも集める
+    #    （netstat / lsof の起動は、ロックが取れたPIDファイルのポートの確認も含めて1回）
+    stopped_ports = {port for _, port in pidfile_targets}
+    ports_to_check = [port for port in [DEFAULT_PORT] + FALLBACK_PORTS if port not in stopped_ports]
+    listening = get_pids_using_ports(ports_to_check + [port for _, port in unlocked_entries])
+    for pid, port in unlocked_entries:
+        if listening.get(port) == pid:
+            # 記録されたPIDがまだそのポートで待ち受けている: ロックがないだけなので終了させる
+            pidfile_targets.append((pid, port))
+            stopped_ports.add(port)
+        else:
+            # 残っていたPIDファイル: 同じPIDが別のプロセスに再利用されていても終了させない
+            # （ポート自体は下のスキャン対象に残す）
+            print(f"[!] PID {pid} (ポート: {port}) は既に終了しています")
     for port in ports_to_check:
         if port in stopped_ports:
             continue
-        
-        pid = get_pid_using_port(port)
+        pid = listening.get(port)
         if pid:
-            try:
-                if sys.platform == 'win32':
-                    # Windows: taskkill /F /PID で強制終了
-                    subprocess.run(
-                        ['taskkill', '/F', '/PID', str(pid)],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        creationflags=subprocess.CREATE_NO_WINDOW
-                    )
-                else:
-                    # Linux/macOS: signal.SIGTERM
-                    os.kill(pid, signal.SIGTERM)
-                
-                print(f"[OK] ポート {port} を使用中のサービスを停止しました (PID: {pid})")
-                success_count += 1
-            except (ProcessLookupError, OSError):
-                pass
+            scanned_targets.append((pid, port))
+    
+    # 3. まとめて終了させる（Windowsでは taskkill の起動が1回で済む）
+    all_pids = list(dict.fromkeys(pid for pid, _ in pidfile_targets + scanned_targets))
+    failed = _terminate_processes(all_pids)
+    
+    for pid, port in pidfile_targets:
+        if pid in failed:
+            print(f"[!] PID {pid} (ポート: {port}) は既に終了しています")
+        else:
+            print(f"[OK] サービスを停止しました (PID: {pid}, ポート: {port})")
+            success_count += 1
+    for pid, port in scanned_targets:
+        if pid not in failed:
+            print(f"[OK] ポート {port} を使用中のサービスを停止しました (PID: {pid})")
+            success_count += 1
+    
+    # 4. 終了させた後でPIDファイルを削除
+    for pid_file in pid_files_to_remove:
+        try:
+            pid_file.unlink()
+        except OSError:
+            pass
+    if LATEST_PID_FILE.exists():
+        LATEST_PID_FILE.unlink()
     
     if success_count > 0:
         print(f"\n[*] 合計 {success_count} 個のサービスを停止しました")
@@ -193,7 +430,7 @@ def stop_service():
 def _is_process_alive(pid):
     """プロセスが生存しているか確認"""
     try:
-        if sys.platform == 'win32':
+        if IS_WINDOWS:
             import subprocess
             result = subprocess.run(
                 ['tasklist', '/FI', f'PID eq {pid}', '/NH', '/FO', 'CSV'],
@@ -214,37 +451,38 @@ def status_service():
     instances = []
 
     # 1. PIDファイルから情報収集
+    pid_entries = []
     if PID_INSTANCES_DIR.exists():
         for pid_file in sorted(PID_INSTANCES_DIR.glob('port_*.pid')):
             try:
                 port = int(pid_file.stem.split('_')[1])
                 with open(pid_file, 'r', encoding='utf-8') as f:
                     pid = int(f.read().strip())
-
-                alive = _is_process_alive(pid)
-                # ポートで実際にLISTENしているPIDも確認
-                actual_pid = get_pid_using_port(port)
-                listening = actual_pid is not None
-
-                instances.append({
-                    'port': port,
-                    'pid': pid,
-                    'alive': alive,
-                    'listening': listening,
-                    'actual_pid': actual_pid,
-                    'source': 'pidfile',
-                })
+                pid_entries.append((port, pid))
             except Exception:
                 pass
 
-    tracked_ports = {inst['port'] for inst in instances}
+    # ポートで実際にLISTENしているPIDは、PIDファイルのポートとスキャン対象をまとめて1回で調べる
+    tracked_ports = {port for port, _ in pid_entries}
+    ports_to_check = [DEFAULT_PORT] + FALLBACK_PORTS
+    listening_pids = get_pids_using_ports(tracked_ports.union(ports_to_check))
+
+    for port, pid in pid_entries:
+        actual_pid = listening_pids.get(port)
+        instances.append({
+            'port': port,
+            'pid': pid,
+            'alive': _is_process_alive(pid),
+            'listening': actual_pid is not None,
+            'actual_pid': actual_pid,
+            'source': 'pidfile',
+        })
 
     # 2. PIDファイルに記録されていないポートもスキャン
-    ports_to_check = [DEFAULT_PORT] + FALLBACK_PORTS
     for port in ports_to_check:
         if port in tracked_ports:
             continue
-        pid = get_pid_using_port(port)
+        pid = listening_pids.get(port)
         if pid:
             instances.append({
                 'port': port,
@@ -339,12 +577,10 @@ def start_service(args):
             'stderr': log_fp,
             'env': child_env,
         }
-        if sys.platform == 'win32':
-            creationflags = 0
-            creationflags |= getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)
-            creationflags |= getattr(subprocess, 'DETACHED_PROCESS', 0)
-            creationflags |= getattr(subprocess, 'CREATE_NO_WINDOW', 0)
-            popen_kwargs['creationflags'] = creationflags
+        if IS_WINDOWS:
+            popen_kwargs['creationflags'] = (
+                subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS | subprocess.CREATE_NO_WINDOW
+            )
         else:
             popen_kwargs['start_new_session'] = True
             popen_kwargs['close_fds'] = True
@@ -355,20 +591,30 @@ def start_service(args):
     print(f"   ログ: {log_path}")
 
     # 子プロセスが起動してポートを書き込むまで少し待って表示用のURLを推測する
+    # 待機は sleep ではなく子プロセスの終了待ちで行い、起動に失敗して終了した場合はすぐに抜ける
     detected_port = None
+    child_exited = False
     for _ in range(30):  # 最大3秒
         try:
-            if LATEST_PID_FILE.exists():
-                st = LATEST_PID_FILE.stat()
-                if st.st_mtime_ns >= start_time_ns:
-                    txt = LATEST_PID_FILE.read_text(encoding='utf-8').strip()
+            # 開いたファイルの fstat で更新日時を確かめ、そのまま読む（stat と読み込みで開き直さない）
+            with open(LATEST_PID_FILE, 'rb') as f:
+                if os.fstat(f.fileno()).st_mtime_ns >= start_time_ns:
+                    txt = f.read().strip()
                     if txt.isdigit():
                         detected_port = int(txt)
                         break
         except Exception:
             pass
-        time.sleep(0.1)
+        try:
+            proc.wait(timeout=0.1)
+            child_exited = True
+            break
+        except subprocess.TimeoutExpired:
+            pass
 
+    if child_exited:
+        print(f"[ERROR] サービスが起動直後に終了しました (終了コード: {proc.returncode})。ログを確認してください")
+        return 1
     if detected_port:
         print(f"   ローカル: http://localhost:{detected_port}")
     else:
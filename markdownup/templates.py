@@ -1,6 +1,43 @@
 # -*- coding: utf-8 -*-
 """HTMLテンプレート定義"""
 
+import string
+
+
+def split_template(template):
+    """
+    str.format 形式のテンプレートを (静的部分のUTF-8バイト列, フィールド名) の列に分解する。
+    {{ }} のエスケープは解除済みになるため、以降は連結だけで差し込める
+    （リクエストごとに str.format でテンプレート全体を走査・エンコードしないようにする）。
+    """
+    parts = []
+    # parse() は {{ }} のたびに静的部分を区切るため、フィールドの手前までを1つにまとめる
+    literals = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        literals.append(literal)
+        if field is not None:
+            parts.append((''.join(literals).encode('utf-8'), field))
+            literals.clear()
+    if literals:
+        parts.append((''.join(literals).encode('utf-8'), None))
+    return tuple(parts)
+
+
+def render_template_chunks(parts, **values):
+    """
+    split_template() で分解したテンプレートに値を差し込み、UTF-8バイト列のリストで返す。
+    静的部分は共有のバイト列をそのまま使うため、ページ全体を連結したコピーを作らない。
+    値にはエンコード済みのバイト列も渡せる（固定のHTML断片を毎回エンコードしないため）。
+    """
+    out = []
+    for literal, field in parts:
+        out.append(literal)
+        if field is not None:
+            value = values[field]
+            out.append(value if isinstance(value, bytes) else value.encode('utf-8'))
+    return out
+
+
 # HTML テンプレート（ディレクトリ一覧表示用）
 HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="ja" data-theme="light">
@@ -304,35 +341,62 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         }}
 
         // ========== 自動リロード（更新検知） ==========
+        // __sig__?wait=1 はサーバー側で変化を待つロングポーリング。応答ごとに次の要求を発行する
+        // （すぐに応答が返った場合は最低 AUTO_RELOAD_INTERVAL_MS の間隔を空ける）
         const AUTO_RELOAD_INTERVAL_MS = 2000;
         let autoReloadSig = null;
-        let autoReloadTimer = null;
+        let autoReloadAbort = null;
 
-        async function fetchSignature() {{
+        async function fetchSignature(wait, signal) {{
             const path = window.location.pathname;
-            const url = '/__sig__?path=' + encodeURIComponent(path);
-            const response = await fetch(url, {{ cache: 'no-store' }});
+            let url = '/__sig__?path=' + encodeURIComponent(path);
+            if (wait) url += '&wait=1';
+            // no-cache: 毎回サーバーに再検証し、未更新なら304（ETag）でボディ転送を省く
+            const response = await fetch(url, {{ cache: 'no-cache', signal }});
             if (!response.ok) return null;
             return await response.json();
         }}
 
-        async function initAutoReload() {{
+        function stopAutoReload() {{
+            if (autoReloadAbort) {{
+                autoReloadAbort.abort();
+                autoReloadAbort = null;
+            }}
+        }}
+
+        // resume=true の場合は取得済みのシグネチャを基準に待機を再開する（非表示中の更新も検知する）
+        async function initAutoReload(resume = false) {{
+            stopAutoReload();
+            const controller = new AbortController();
+            autoReloadAbort = controller;
             try {{
-                const info = await fetchSignature();
-                if (!info || !info.exists) return;
-                autoReloadSig = info.sig;
-                if (autoReloadTimer) clearInterval(autoReloadTimer);
-                autoReloadTimer = setInterval(async () => {{
+                if (!resume || autoReloadSig === null) {{
+                    const info = await fetchSignature(false, controller.signal);
+                    if (!info || !info.exists) return;
+                    autoReloadSig = info.sig;
+                }}
+                // 非表示のタブでは待機を始めない（ブラウザのホストあたりの同時接続数を占有しないため）
+                if (document.hidden) {{
+                    if (autoReloadAbort === controller) autoReloadAbort = null;
+                    return;
+                }}
+                while (!controller.signal.aborted) {{
+                    const started = Date.now();
                     try {{
-                        const now = await fetchSignature();
-                        if (!now || !now.exists) return;
-                        if (autoReloadSig !== null && now.sig !== autoReloadSig) {{
+                        const now = await fetchSignature(true, controller.signal);
+                        if (controller.signal.aborted) return;
+                        if (now && now.exists && autoReloadSig !== null && now.sig !== autoReloadSig) {{
                             location.reload();
+                            return;
                         }}
                     }} catch (e) {{
-                        // ignore
+                        if (controller.signal.aborted) return;
                     }}
-                }}, AUTO_RELOAD_INTERVAL_MS);
+                    const elapsed = Date.now() - started;
+                    if (elapsed < AUTO_RELOAD_INTERVAL_MS) {{
+                        await new Promise(resolve => setTimeout(resolve, AUTO_RELOAD_INTERVAL_MS - elapsed));
+                    }}
+                }}
             }} catch (e) {{
                 // ignore
             }}
@@ -348,10 +412,27 @@ HTML_TEMPLATE = """<!DOCTYPE html>
             initAutoReload();
         }});
         window.addEventListener('hashchange', scrollToHash);
+        // 非表示になったタブはロングポーリングを中断し、再表示されたら再開する
+        document.addEventListener('visibilitychange', () => {{
+            if (document.hidden) {{
+                stopAutoReload();
+            }} else if (!autoReloadAbort) {{
+                initAutoReload(true);
+            }}
+        }});
         
         // ========== ナビゲーションショートカット ==========
         let navInfo = null;
         
+        // 表示に必要ない処理はブラウザの空き時間に回す（requestIdleCallback 非対応なら setTimeout）
+        function runWhenIdle(fn) {{
+            if ('requestIdleCallback' in window) {{
+                requestIdleCallback(() => fn(), {{ timeout: 2000 }});
+            }} else {{
+                setTimeout(fn, 1);
+            }}
+        }}
+        
         async function loadNavInfo() {{
             try {{
                 const currentPath = window.location.pathname;
@@ -382,19 +463,28 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         function focusNext() {{
             if (focusableElements.length === 0) return;
             currentFocusIndex = (currentFocusIndex + 1) % focusableElements.length;
-            focusableElements[currentFocusIndex].focus();
+            // focus() 自体のスクロールは止め、中央へのスムーズスクロール1回だけにする
+            focusableElements[currentFocusIndex].focus({{ preventScroll: true }});
             focusableElements[currentFocusIndex].scrollIntoView({{ behavior: 'smooth', block: 'center' }});
         }}
         
         function focusPrev() {{
             if (focusableElements.length === 0) return;
             currentFocusIndex = currentFocusIndex <= 0 ? focusableElements.length - 1 : currentFocusIndex - 1;
-            focusableElements[currentFocusIndex].focus();
+            // focus() 自体のスクロールは止め、中央へのスムーズスクロール1回だけにする
+            focusableElements[currentFocusIndex].focus({{ preventScroll: true }});
             focusableElements[currentFocusIndex].scrollIntoView({{ behavior: 'smooth', block: 'center' }});
         }}
         
         // ========== キーボードショートカット ==========
+        // 入力欄・編集中の要素かどうか（文字入力中はショートカットを処理しない）
+        function isEditableTarget(el) {{
+            return !!el && (el.isContentEditable || el.tagName === 'INPUT' || el.tagName === 'TEXTAREA' || el.tagName === 'SELECT');
+        }}
+        
         document.addEventListener('keydown', (e) => {{
+            if (isEditableTarget(e.target)) return;
+            
             // Ctrl+Alt+A: ルートへ移動
             if (e.ctrlKey && e.altKey && !e.shiftKey && (e.key === 'a' || e.key === 'A')) {{
                 e.preventDefault();
@@ -431,19 +521,31 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         // ========== 設定ダイアログ ==========
         const SETTINGS_KEY = 'markdownup_settings';
         
+        // 読み込んだ設定のキャッシュ（localStorage の読み込みとJSON解析は初回だけにする）
+        let settingsCache = null;
+        
         function getSettings() {{
+            if (settingsCache) return settingsCache;
             try {{
                 const saved = localStorage.getItem(SETTINGS_KEY);
                 if (saved) {{
-                    return JSON.parse(saved);
+                    settingsCache = JSON.parse(saved);
+                    return settingsCache;
                 }}
             }} catch (e) {{
                 console.warn('Failed to load settings:', e);
             }}
-            return {{ theme: 'light', h1h2Margin: 'none', contentMargin: 'normal', tocEnabled: true, tocLevel: 1 }};
+            settingsCache = {{ theme: 'light', h1h2Margin: 'none', contentMargin: 'normal', tocEnabled: true, tocLevel: 1 }};
+            return settingsCache;
         }}
         
+        // 他のタブで設定が変更されたらキャッシュを破棄する
+        window.addEventListener('storage', (e) => {{
+            if (e.key === SETTINGS_KEY || e.key === null) settingsCache = null;
+        }});
+        
         function saveSettings(settings) {{
+            settingsCache = settings;
             try {{
                 localStorage.setItem(SETTINGS_KEY, JSON.stringify(settings));
             }} catch (e) {{
@@ -539,7 +641,7 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         }})();
         
         window.addEventListener('load', () => {{
-            loadNavInfo();
+            runWhenIdle(loadNavInfo);
             initFocusableElements();
         }});
         
@@ -566,6 +668,9 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </body>
 </html>"""
 
+# 事前に分解したディレクトリ一覧用テンプレート（render_template_chunks() で使用）
+HTML_TEMPLATE_PARTS = split_template(HTML_TEMPLATE)
+
 # 設定ボタンとダイアログのHTML（ルートディレクトリのみに表示）
 SETTINGS_SECTION_HTML = """<button class="mdf2h-settings-btn" onclick="openSettingsDialog()">⚙️ 設定</button>
     <div class="mdf2h-settings-overlay">
@@ -611,10 +716,21 @@ SETTINGS_SECTION_HTML = """<button class="mdf2h-settings-btn" onclick="openSetti
         </div>
     </div>"""
 
+# エンコード済みの設定セクション（ディレクトリ一覧のテンプレートにそのまま差し込む）
+SETTINGS_SECTION_BYTES = SETTINGS_SECTION_HTML.encode('utf-8')
 
-def get_print_html_template():
-    """Markdown表示用HTMLテンプレートを返す（Ctrl+P印刷対応）"""
-    return '''<!DOCTYPE html>
+
+# コードブロックに付けるCopyボタン（GitHub Octicons の copy / check アイコン）
+# サーバー側で <pre> を .mdf2h-codewrap で囲んで付与し、クリックはテンプレートのJSが受ける
+CODE_COPY_BUTTON_HTML = (
+    '<button type="button" class="mdf2h-copy-btn" title="Copy">'
+    '<svg class="mdf2h-copy-icon" viewBox="0 0 16 16" fill="currentColor"><path d="M0 6.75C0 5.784.784 5 1.75 5h1.5a.75.75 0 0 1 0 1.5h-1.5a.25.25 0 0 0-.25.25v7.5c0 .138.112.25.25.25h7.5a.25.25 0 0 0 .25-.25v-1.5a.75.75 0 0 1 1.5 0v1.5A1.75 1.75 0 0 1 9.25 16h-7.5A1.75 1.75 0 0 1 0 14.25Z"></path><path d="M5 1.75C5 .784 5.784 0 6.75 0h7.5C15.216 0 16 .784 16 1.75v7.5A1.75 1.75 0 0 1 14.25 11h-7.5A1.75 1.75 0 0 1 5 9.25Zm1.75-.25a.25.25 0 0 0-.25.25v7.5c0 .138.112.25.25.25h7.5a.25.25 0 0 0 .25-.25v-7.5a.25.25 0 0 0-.25-.25Z"></path></svg>'
+    '<svg class="mdf2h-copy-done" viewBox="0 0 16 16" fill="currentColor"><path d="M13.78 4.22a.75.75 0 0 1 0 1.06l-7.25 7.25a.75.75 0 0 1-1.06 0L2.22 9.28a.751.751 0 0 1 .018-1.042.751.751 0 0 1 1.042-.018L6 10.94l6.72-6.72a.75.75 0 0 1 1.06 0Z"></path></svg>'
+    '</button>'
+)
+
+# Markdown表示用HTMLテンプレート（Ctrl+P印刷対応）
+PRINT_HTML_TEMPLATE = '''<!DOCTYPE html>
 <html lang="ja" data-theme="light">
 <head>
     <meta charset="UTF-8">
@@ -971,6 +1087,17 @@ def get_print_html_template():
             width: 16px;
             height: 16px;
         }}
+        /* コピー直後はチェックアイコンに切り替える */
+        .mdf2h-copy-btn .mdf2h-copy-done,
+        .mdf2h-copy-btn.copied .mdf2h-copy-icon {{
+            display: none;
+        }}
+        .mdf2h-copy-btn.copied .mdf2h-copy-done {{
+            display: block;
+        }}
+        .mdf2h-copy-btn.copied {{
+            color: #1a7f37;
+        }}
 
         /* ========== トースト通知 ==========
            - pointer-events:none で操作を邪魔しない */
@@ -1071,7 +1198,8 @@ def get_print_html_template():
             max-width: 100% !important;
             height: auto;
         }}
-        .mdf2h-presentation-hidden {{
+        /* 見出しの折りたたみで隠した要素 */
+        .mdf2h-folded {{
             display: none !important;
         }}
         /* コードブロックラッパーにマージン適用（Copyボタンも追従） */
@@ -1145,6 +1273,16 @@ def get_print_html_template():
         .mdf2h-inline-toc li.toc-level-h4 a {{
             font-size: 1em;
         }}
+        /* 設定（目次の表示・階層）に合わせて非表示にする（data-top-level: TOC内で最も浅い見出しレベル） */
+        [data-toc-enabled="false"] .mdf2h-inline-toc,
+        [data-toc-level="1"] .mdf2h-inline-toc[data-top-level="3"],
+        [data-toc-level="1"] .mdf2h-inline-toc[data-top-level="4"],
+        [data-toc-level="2"] .mdf2h-inline-toc[data-top-level="4"],
+        [data-toc-level="1"] .mdf2h-inline-toc li.toc-level-h3,
+        [data-toc-level="1"] .mdf2h-inline-toc li.toc-level-h4,
+        [data-toc-level="2"] .mdf2h-inline-toc li.toc-level-h4 {{
+            display: none;
+        }}
         @media print {{
             .mdf2h-inline-toc {{
                 display: none;
@@ -1259,6 +1397,30 @@ def get_print_html_template():
         import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@11/dist/mermaid.esm.min.mjs';
         mermaid.initialize({{ startOnLoad: false }});
 
+        // ========== 本文・見出しの参照 ==========
+        // 本文の要素はページ内で差し替えられないため一度だけ取得する（module スクリプトはHTML解析後に実行される）
+        const articleEl = document.querySelector('.markdown-body');
+        // 本文の H1〜H4（印刷用目次内は除く）を文書順に保持する。見出しが増減しうる操作の後は refreshHeadings() で取り直す
+        let cachedHeadings = null;
+        
+        function getArticleHeadings() {{
+            if (!cachedHeadings) {{
+                cachedHeadings = articleEl
+                    ? Array.from(articleEl.querySelectorAll('h1, h2, h3, h4')).filter(h => !h.closest('.mdf2h-print-toc'))
+                    : [];
+            }}
+            return cachedHeadings;
+        }}
+        
+        function refreshHeadings() {{
+            cachedHeadings = null;
+            // 増えた見出しもフォーカス可能にし、フォーカス移動の一覧も同じ配列に差し替える
+            getArticleHeadings().forEach((heading) => {{
+                heading.setAttribute('tabindex', '0');
+            }});
+            initFocusableElements();
+        }}
+
         function decodeHashId(raw) {{
             try {{
                 return decodeURIComponent(raw);
@@ -1278,102 +1440,77 @@ def get_print_html_template():
         }}
 
         // ========== 自動リロード（更新検知） ==========
+        // __sig__?wait=1 はサーバー側で変化を待つロングポーリング。応答ごとに次の要求を発行する
+        // （すぐに応答が返った場合は最低 AUTO_RELOAD_INTERVAL_MS の間隔を空ける）
         const AUTO_RELOAD_INTERVAL_MS = 2000;
         let autoReloadSig = null;
-        let autoReloadTimer = null;
+        let autoReloadAbort = null;
 
-        async function fetchSignature() {{
+        async function fetchSignature(wait, signal) {{
             const path = window.location.pathname;
-            const url = '/__sig__?path=' + encodeURIComponent(path);
-            const response = await fetch(url, {{ cache: 'no-store' }});
+            let url = '/__sig__?path=' + encodeURIComponent(path);
+            if (wait) url += '&wait=1';
+            // no-cache: 毎回サーバーに再検証し、未更新なら304（ETag）でボディ転送を省く
+            const response = await fetch(url, {{ cache: 'no-cache', signal }});
             if (!response.ok) return null;
             return await response.json();
         }}
 
-        async function initAutoReload() {{
+        function stopAutoReload() {{
+            if (autoReloadAbort) {{
+                autoReloadAbort.abort();
+                autoReloadAbort = null;
+            }}
+        }}
+
+        // resume=true の場合は取得済みのシグネチャを基準に待機を再開する（非表示中の更新も検知する）
+        async function initAutoReload(resume = false) {{
+            stopAutoReload();
+            const controller = new AbortController();
+            autoReloadAbort = controller;
             try {{
-                const info = await fetchSignature();
-                if (!info || !info.exists) return;
-                autoReloadSig = info.sig;
-                if (autoReloadTimer) clearInterval(autoReloadTimer);
-                autoReloadTimer = setInterval(async () => {{
+                if (!resume || autoReloadSig === null) {{
+                    const info = await fetchSignature(false, controller.signal);
+                    if (!info || !info.exists) return;
+                    autoReloadSig = info.sig;
+                }}
+                // 非表示のタブでは待機を始めない（ブラウザのホストあたりの同時接続数を占有しないため）
+                if (document.hidden) {{
+                    if (autoReloadAbort === controller) autoReloadAbort = null;
+                    return;
+                }}
+                while (!controller.signal.aborted) {{
+                    const started = Date.now();
                     try {{
-                        const now = await fetchSignature();
-                        if (!now || !now.exists) return;
-                        if (autoReloadSig !== null && now.sig !== autoReloadSig) {{
+                        const now = await fetchSignature(true, controller.signal);
+                        if (controller.signal.aborted) return;
+                        if (now && now.exists && autoReloadSig !== null && now.sig !== autoReloadSig) {{
                             savePresentationState();
                             location.reload();
+                            return;
                         }}
                     }} catch (e) {{
-                        // ignore
+                        if (controller.signal.aborted) return;
+                    }}
+                    const elapsed = Date.now() - started;
+                    if (elapsed < AUTO_RELOAD_INTERVAL_MS) {{
+                        await new Promise(resolve => setTimeout(resolve, AUTO_RELOAD_INTERVAL_MS - elapsed));
                     }}
-                }}, AUTO_RELOAD_INTERVAL_MS);
+                }}
             }} catch (e) {{
                 // ignore
             }}
         }}
 
-        // ページ読み込み後、複数のタイミングで試行
-        window.addEventListener('load', () => {{
+        // ページ読み込み後、複数のタイミングで試行（読み込み時の初期化処理から呼ぶ）
+        function initHashScroll() {{
             scrollToHash();
             // Mermaid等の遅延レンダリングに対応
             setTimeout(scrollToHash, 100);
             setTimeout(scrollToHash, 500);
             setTimeout(scrollToHash, 1000);
-            initAutoReload();
-        }});
-        window.addEventListener('hashchange', scrollToHash);
-        
-        // ========== インラインTOC（H1の下に見出し一覧） ==========
-        function insertTocUnderH1() {{
-            const article = document.querySelector('.markdown-body');
-            if (!article) return;
-            
-            // 既にTOCが挿入されていたら削除（設定変更で再生成するため）
-            const existing = article.querySelector('.mdf2h-inline-toc');
-            if (existing) existing.remove();
-            
-            const settings = getSettings();
-            if (settings.tocEnabled === false) return;
-            
-            // H1を探す
-            const h1 = article.querySelector('h1');
-            if (!h1) return;
-            
-            const tocLevel = settings.tocLevel || 1;
-            const selectorMap = {{ 1: 'h2', 2: 'h2, h3', 3: 'h2, h3, h4' }};
-            const selector = selectorMap[tocLevel] || 'h2';
-            const headings = article.querySelectorAll(selector);
-            if (headings.length === 0) return;
-            
-            // TOCを作成
-            const nav = document.createElement('nav');
-            nav.className = 'mdf2h-inline-toc';
-            const ul = document.createElement('ul');
-            const skipTexts = ['目次', 'TOC', 'Table of Contents'];
-            
-            headings.forEach((heading, index) => {{
-                const text = heading.textContent.trim();
-                if (skipTexts.includes(text)) return;
-                
-                if (!heading.id) {{
-                    heading.id = 'toc-' + heading.tagName.toLowerCase() + '-' + index;
-                }}
-                const li = document.createElement('li');
-                if (heading.tagName === 'H3') li.className = 'toc-level-h3';
-                if (heading.tagName === 'H4') li.className = 'toc-level-h4';
-                const a = document.createElement('a');
-                a.href = '#' + heading.id;
-                a.textContent = text;
-                li.appendChild(a);
-                ul.appendChild(li);
-            }});
-            
-            nav.appendChild(ul);
-            
-            // H1の直後に挿入
-            h1.insertAdjacentElement('afterend', nav);
         }}
+        window.addEventListener('hashchange', scrollToHash);
         
         // 印刷前に目次とcreditsを生成
         const headerMode = {header_mode};
@@ -1394,7 +1531,7 @@ def get_print_html_template():
 
         // ========== 画像を含むリストアイテムのマーカー非表示 ==========
         function initImageListItems() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
             const listItems = article.querySelectorAll('li');
@@ -1449,7 +1586,7 @@ def get_print_html_template():
         
         // ========== 画像クリックで3段階サイズ切替 ==========
         function initImageSizeToggle() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
             const images = article.querySelectorAll('img');
@@ -1482,7 +1619,7 @@ def get_print_html_template():
         
         // ========== テーブルクリックで3段階サイズ切替 ==========
         function initTableSizeToggle() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
 
             const tables = Array.from(article.querySelectorAll('table'));
@@ -1580,10 +1717,7 @@ def get_print_html_template():
                 body.classList.add('mdf2h-edit-mode');
                 showToast('編集モード ON（Ctrl+Alt+E で保存 / Esc で破棄）', true);
                 // 編集中は自動リロードを停止
-                if (autoReloadTimer) {{
-                    clearInterval(autoReloadTimer);
-                    autoReloadTimer = null;
-                }}
+                stopAutoReload();
                 enableEditing();
             }} else {{
                 body.classList.remove('mdf2h-edit-mode');
@@ -1606,7 +1740,7 @@ def get_print_html_template():
         }}
         
         function enableEditing() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
             // 直接の子要素にクリックイベントを追加
@@ -1628,7 +1762,7 @@ def get_print_html_template():
         }}
         
         function disableEditing() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
             const editables = article.querySelectorAll('[contenteditable="true"]');
@@ -1636,6 +1770,8 @@ def get_print_html_template():
                 el.contentEditable = 'false';
                 el.removeEventListener('blur', handleElementBlur);
             }});
+            // 編集（貼り付け等）で見出しが増減した可能性があるため取り直す
+            refreshHeadings();
             
             // クリックイベントも除去
             const children = Array.from(article.children);
@@ -1678,7 +1814,7 @@ def get_print_html_template():
         }}
         
         async function saveChanges() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) {{
                 showToast('保存対象が見つかりません', false);
                 return;
@@ -1850,63 +1986,38 @@ def get_print_html_template():
             }}
         }}
 
-        function initCodeCopyButtons() {{
-            const article = document.querySelector('.markdown-body');
-            if (!article) return;
-
-            const pres = Array.from(article.querySelectorAll('pre'));
-            pres.forEach((pre) => {{
-                // Mermaidは除外
-                if (pre.classList.contains('mermaid')) return;
-                // 印刷用の要素内は除外
-                if (pre.closest('.mdf2h-print-toc') || pre.closest('.mdf2h-print-credits')) return;
-                // 既にラップ済みならスキップ
-                if (pre.closest('.mdf2h-codewrap')) return;
-
-                const code = pre.querySelector('code');
-                const textSource = code || pre;
-                const text = (textSource.textContent || '');
-                if (!text.trim()) return;
-
-                const wrapper = document.createElement('div');
-                wrapper.className = 'mdf2h-codewrap';
-
-                const btn = document.createElement('button');
-                btn.type = 'button';
-                btn.className = 'mdf2h-copy-btn';
-                btn.title = 'Copy';
-                // クリップボードアイコン (GitHub Octicons copy)
-                const copyIcon = '<svg viewBox="0 0 16 16" fill="currentColor"><path d="M0 6.75C0 5.784.784 5 1.75 5h1.5a.75.75 0 0 1 0 1.5h-1.5a.25.25 0 0 0-.25.25v7.5c0 .138.112.25.25.25h7.5a.25.25 0 0 0 .25-.25v-1.5a.75.75 0 0 1 1.5 0v1.5A1.75 1.75 0 0 1 9.25 16h-7.5A1.75 1.75 0 0 1 0 14.25Z"></path><path d="M5 1.75C5 .784 5.784 0 6.75 0h7.5C15.216 0 16 .784 16 1.75v7.5A1.75 1.75 0 0 1 14.25 11h-7.5A1.75 1.75 0 0 1 5 9.25Zm1.75-.25a.25.25 0 0 0-.25.25v7.5c0 .138.112.25.25.25h7.5a.25.25 0 0 0 .25-.25v-7.5a.25.25 0 0 0-.25-.25Z"></path></svg>';
-                // チェックアイコン (GitHub Octicons check)
-                const checkIcon = '<svg viewBox="0 0 16 16" fill="currentColor"><path d="M13.78 4.22a.75.75 0 0 1 0 1.06l-7.25 7.25a.75.75 0 0 1-1.06 0L2.22 9.28a.751.751 0 0 1 .018-1.042.751.751 0 0 1 1.042-.018L6 10.94l6.72-6.72a.75.75 0 0 1 1.06 0Z"></path></svg>';
-                btn.innerHTML = copyIcon;
-
-                btn.addEventListener('click', async (ev) => {{
-                    ev.preventDefault();
-                    ev.stopPropagation();
-                    const ok = await copyTextToClipboard(textSource.textContent || '');
-                    if (ok) {{
-                        btn.innerHTML = checkIcon;
-                        btn.style.color = '#1a7f37';
-                        showToast('Copied!', true);
-                        window.setTimeout(() => {{ 
-                            btn.innerHTML = copyIcon;
-                            btn.style.color = '';
-                        }}, 900);
-                    }} else {{
-                        showToast('Copy failed', false);
-                    }}
-                }});
-
-                // DOM差し替え: pre を wrapper に移動してボタンを重ねる
-                pre.parentNode.insertBefore(wrapper, pre);
-                wrapper.appendChild(btn);
-                wrapper.appendChild(pre);
-            }});
+        // Copyボタン（サーバー側で各コードブロックに付与済み）のクリックをまとめて受ける
+        // 編集モードで本文の要素に付くクリック処理より先に受けるため、捕捉フェーズで登録する
+        document.addEventListener('click', async (ev) => {{
+            const btn = ev.target.closest ? ev.target.closest('.mdf2h-copy-btn') : null;
+            if (!btn) return;
+            ev.preventDefault();
+            ev.stopPropagation();
+            const pre = btn.parentNode.querySelector('pre');
+            if (!pre) return;
+            const textSource = pre.querySelector('code') || pre;
+            const ok = await copyTextToClipboard(textSource.textContent || '');
+            if (ok) {{
+                btn.classList.add('copied');
+                showToast('Copied!', true);
+                window.setTimeout(() => btn.classList.remove('copied'), 900);
+            }} else {{
+                showToast('Copy failed', false);
+            }}
+        }}, true);
+        
+        // HTML文字列に埋め込むテキストのエスケープ
+        function escapeHtml(text) {{
+            return String(text)
+                .replace(/&/g, '&amp;')
+                .replace(/</g, '&lt;')
+                .replace(/>/g, '&gt;')
+                .replace(/"/g, '&quot;')
+                .replace(/'/g, '&#39;');
         }}
         
         async function generatePrintContent() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
             // TOCは常に再生成（見出しが変わった場合に対応）
@@ -1919,37 +2030,19 @@ def get_print_html_template():
             const settings = getSettings();
             if (settings.tocEnabled !== false) {{
                 const tocLevel = settings.tocLevel || 1;
-                const selectorMap = {{ 1: 'h2', 2: 'h2, h3', 3: 'h2, h3, h4' }};
-                const selector = selectorMap[tocLevel] || 'h2';
-                const headings = article.querySelectorAll(selector);
+                const tagsMap = {{ 1: ['H2'], 2: ['H2', 'H3'], 3: ['H2', 'H3', 'H4'] }};
+                const tags = tagsMap[tocLevel] || tagsMap[1];
+                const headings = getArticleHeadings().filter(h => tags.includes(h.tagName));
                 if (headings.length > 0) {{
                     const tocDiv = document.createElement('div');
                     tocDiv.className = 'mdf2h-print-toc';
-                    tocDiv.innerHTML = '<h2>目次</h2>';
-                    tocDiv.querySelector('h2').setAttribute('tabindex', '-1');
-                    const ul = document.createElement('ul');
-                    
-                    headings.forEach((heading, index) => {{
-                        const li = document.createElement('li');
-                        const a = document.createElement('a');
-                        const id = heading.id || 'heading-' + index;
-                        if (!heading.id) heading.id = id;
-                        a.href = '#' + id;
-                        a.textContent = heading.textContent;
-                        li.appendChild(a);
-                        
-                        if (heading.tagName === 'H2') {{
-                            li.className = 'toc-h2';
-                        }} else if (heading.tagName === 'H3') {{
-                            li.className = 'toc-h3';
-                        }} else if (heading.tagName === 'H4') {{
-                            li.className = 'toc-h4';
-                        }}
-                        
-                        ul.appendChild(li);
+                    // 項目ごとに要素を作らず、HTML文字列を組み立てて一度に設定する
+                    const items = headings.map((heading, index) => {{
+                        if (!heading.id) heading.id = 'heading-' + index;
+                        const cls = 'toc-' + heading.tagName.toLowerCase();
+                        return `<li class="${{cls}}"><a href="#${{escapeHtml(heading.id)}}">${{escapeHtml(heading.textContent)}}</a></li>`;
                     }});
-                    
-                    tocDiv.appendChild(ul);
+                    tocDiv.innerHTML = `<h2 tabindex="-1">目次</h2><ul>${{items.join('')}}</ul>`;
                     
                     if (h1 && h1.nextSibling) {{
                         article.insertBefore(tocDiv, h1.nextSibling);
@@ -1992,11 +2085,19 @@ def get_print_html_template():
         }}
         
         window.addEventListener('beforeprint', generatePrintContent);
-        window.addEventListener('load', generatePrintContent);
         
         // ========== ナビゲーションショートカット ==========
         let navInfo = null;
         
+        // 表示に必要ない処理はブラウザの空き時間に回す（requestIdleCallback 非対応なら setTimeout）
+        function runWhenIdle(fn) {{
+            if ('requestIdleCallback' in window) {{
+                requestIdleCallback(() => fn(), {{ timeout: 2000 }});
+            }} else {{
+                setTimeout(fn, 1);
+            }}
+        }}
+        
         async function loadNavInfo() {{
             try {{
                 const currentPath = window.location.pathname;
@@ -2029,48 +2130,70 @@ def get_print_html_template():
         
         // ========== 見出し折りたたみ機能 ==========
         let hoveredHeading = null;
+        // 見出しのタグ名 -> レベル（見出し以外は undefined）
+        const HEADING_LEVELS = {{ H1: 1, H2: 2, H3: 3, H4: 4, H5: 5, H6: 6 }};
+        
+        // イベントの発生元から折りたたみ対象の見出しを探す（印刷用目次内の見出しは対象外）
+        function foldableHeadingOf(target) {{
+            const heading = target.closest ? target.closest('h1, h2, h3, h4') : null;
+            if (!heading || heading.closest('.mdf2h-print-toc')) return null;
+            return heading;
+        }}
+        
+        // 見出しが非常に多い文書でも最初の入力を待たせないよう、tabindex の設定は一定数ずつ分けて行う
+        // （クリック・ホバーは本文への委譲で処理するため、設定が終わる前でも折りたたみは動く）
+        const HEADING_INIT_BATCH_SIZE = 200;
+        
+        function makeHeadingsFocusable(headings, start) {{
+            const end = Math.min(start + HEADING_INIT_BATCH_SIZE, headings.length);
+            for (let i = start; i < end; i++) {{
+                headings[i].setAttribute('tabindex', '0');
+            }}
+            if (end >= headings.length) return;
+            const next = () => makeHeadingsFocusable(headings, end);
+            if (window.scheduler && scheduler.postTask) {{
+                scheduler.postTask(next, {{ priority: 'background' }});
+            }} else {{
+                runWhenIdle(next);
+            }}
+        }}
         
         function initFoldableHeadings() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return;
             
-            // H1〜H4すべてを対象にする（印刷用目次内は除外）
-            const headings = article.querySelectorAll('h1, h2, h3, h4');
-            let count = 0;
-            headings.forEach((heading) => {{
-                // 印刷用目次内の見出しは除外
-                if (heading.closest('.mdf2h-print-toc')) {{
-                    heading.setAttribute('tabindex', '-1');
-                    return;
-                }}
-                count++;
-                // フォーカス可能にする
-                heading.setAttribute('tabindex', '0');
-                // ホバー検出
-                heading.addEventListener('mouseenter', () => {{ hoveredHeading = heading; }});
-                heading.addEventListener('mouseleave', () => {{ hoveredHeading = null; }});
-                // クリックで展開/折りたたみ
-                heading.addEventListener('click', () => {{
-                    setActiveHeading(heading);
-                    toggleHeading(heading);
-                }});
+            // H1〜H4すべてをフォーカス可能にする（印刷用目次内は除外）
+            makeHeadingsFocusable(getArticleHeadings(), 0);
+            
+            // ホバー検出・クリックでの展開/折りたたみは、見出しごとではなく本文にまとめて登録する
+            article.addEventListener('mouseover', (e) => {{
+                hoveredHeading = foldableHeadingOf(e.target);
+            }});
+            article.addEventListener('mouseleave', () => {{ hoveredHeading = null; }});
+            article.addEventListener('click', (e) => {{
+                const heading = foldableHeadingOf(e.target);
+                if (!heading) return;
+                setActiveHeading(heading);
+                toggleHeading(heading);
             }});
         }}
         
         function toggleHeading(heading) {{
-            const isCollapsed = heading.classList.toggle('collapsed');
+            setHeadingCollapsed(heading, !heading.classList.contains('collapsed'));
+        }}
+        
+        function setHeadingCollapsed(heading, isCollapsed) {{
+            heading.classList.toggle('collapsed', isCollapsed);
             
             // 次の同レベル以上の見出しまでのコンテンツを折りたたみ
-            const level = parseInt(heading.tagName.charAt(1));
+            // インラインスタイルではなくクラスの付け外しで隠す（表示の切り替えはCSSに任せる）
+            const level = HEADING_LEVELS[heading.tagName];
             let sibling = heading.nextElementSibling;
             
             while (sibling) {{
-                const tagName = sibling.tagName;
-                if (/^H[1-6]$/.test(tagName)) {{
-                    const siblingLevel = parseInt(tagName.charAt(1));
-                    if (siblingLevel <= level) break;
-                }}
-                sibling.style.display = isCollapsed ? 'none' : '';
+                const siblingLevel = HEADING_LEVELS[sibling.tagName];
+                if (siblingLevel && siblingLevel <= level) break;
+                sibling.classList.toggle('mdf2h-folded', isCollapsed);
                 sibling = sibling.nextElementSibling;
             }}
         }}
@@ -2084,40 +2207,26 @@ def get_print_html_template():
             }}
         }}
         
-        function toggleAllH2() {{
-            const article = document.querySelector('.markdown-body');
-            if (!article) return;
-            
-            const h2s = article.querySelectorAll('h2');
-            if (h2s.length === 0) return;
+        // 同じレベルの見出しをまとめて展開/折りたたみ（最初の見出しの状態で全体を決定）
+        function toggleAllHeadings(tagName) {{
+            const headings = getArticleHeadings().filter(h => h.tagName === tagName);
+            if (headings.length === 0) return;
             
-            // 最初のH2の状態で全体の展開/折りたたみを決定
-            const shouldCollapse = !h2s[0].classList.contains('collapsed');
+            const shouldCollapse = !headings[0].classList.contains('collapsed');
             
-            h2s.forEach(h2 => {{
-                const isCurrentlyCollapsed = h2.classList.contains('collapsed');
-                if (isCurrentlyCollapsed !== shouldCollapse) {{
-                    toggleHeading(h2);
-                }}
-            }});
+            // 状態を変える見出しだけを先に選び、各見出しの状態は1回だけ読む
+            // （同レベルの見出しの折りたたみ範囲は重ならないため、兄弟要素の走査は合計で本文1回分になる）
+            headings
+                .filter(h => h.classList.contains('collapsed') !== shouldCollapse)
+                .forEach(h => setHeadingCollapsed(h, shouldCollapse));
+        }}
+        
+        function toggleAllH2() {{
+            toggleAllHeadings('H2');
         }}
         
         function toggleAllH3() {{
-            const article = document.querySelector('.markdown-body');
-            if (!article) return;
-            
-            const h3s = article.querySelectorAll('h3');
-            if (h3s.length === 0) return;
-            
-            // 最初のH3の状態で全体の展開/折りたたみを決定
-            const shouldCollapse = !h3s[0].classList.contains('collapsed');
-            
-            h3s.forEach(h3 => {{
-                const isCurrentlyCollapsed = h3.classList.contains('collapsed');
-                if (isCurrentlyCollapsed !== shouldCollapse) {{
-                    toggleHeading(h3);
-                }}
-            }});
+            toggleAllHeadings('H3');
         }}
         
         function toggleHoverHeading() {{
@@ -2144,45 +2253,61 @@ def get_print_html_template():
         let currentFocusIndex = -1;
         
         function initFocusableElements() {{
-            // H1〜H4すべてを対象にする（tabindex="0"が設定された要素のみ）
-            focusableElements = Array.from(document.querySelectorAll('.markdown-body h1[tabindex="0"], .markdown-body h2[tabindex="0"], .markdown-body h3[tabindex="0"], .markdown-body h4[tabindex="0"]'));
+            // H1〜H4すべてを対象にする（initFoldableHeadings で tabindex="0" を設定した見出し）
+            focusableElements = getArticleHeadings();
             currentFocusIndex = -1;
         }}
         
         function focusNext() {{
             if (focusableElements.length === 0) return;
             currentFocusIndex = (currentFocusIndex + 1) % focusableElements.length;
-            focusableElements[currentFocusIndex].focus();
+            // focus() 自体のスクロールは止め、中央へのスムーズスクロール1回だけにする
+            focusableElements[currentFocusIndex].focus({{ preventScroll: true }});
             focusableElements[currentFocusIndex].scrollIntoView({{ behavior: 'smooth', block: 'center' }});
         }}
         
         function focusPrev() {{
             if (focusableElements.length === 0) return;
             currentFocusIndex = currentFocusIndex <= 0 ? focusableElements.length - 1 : currentFocusIndex - 1;
-            focusableElements[currentFocusIndex].focus();
+            // focus() 自体のスクロールは止め、中央へのスムーズスクロール1回だけにする
+            focusableElements[currentFocusIndex].focus({{ preventScroll: true }});
             focusableElements[currentFocusIndex].scrollIntoView({{ behavior: 'smooth', block: 'center' }});
         }}
 
         // ========== 設定読み込み ==========
         const SETTINGS_KEY = 'markdownup_settings';
         
+        // 読み込んだ設定のキャッシュ（localStorage の読み込みとJSON解析は初回だけにする）
+        let settingsCache = null;
+        
         function getSettings() {{
+            if (settingsCache) return settingsCache;
             try {{
                 const saved = localStorage.getItem(SETTINGS_KEY);
                 if (saved) {{
-                    return JSON.parse(saved);
+                    settingsCache = JSON.parse(saved);
+                    return settingsCache;
                 }}
             }} catch (e) {{
                 console.warn('Failed to load settings:', e);
             }}
-            return {{ theme: 'light', h1h2Margin: 'none', contentMargin: 'normal', tocEnabled: true, tocLevel: 1 }};
+            settingsCache = {{ theme: 'light', h1h2Margin: 'none', contentMargin: 'normal', tocEnabled: true, tocLevel: 1 }};
+            return settingsCache;
         }}
         
+        // 他のタブで設定が変更されたらキャッシュを破棄する
+        window.addEventListener('storage', (e) => {{
+            if (e.key === SETTINGS_KEY || e.key === null) settingsCache = null;
+        }});
+        
         (function() {{
             const settings = getSettings();
             if (settings.theme) {{
                 document.documentElement.setAttribute('data-theme', settings.theme);
             }}
+            // インラインTOCはサーバー側でH2〜H4まで生成済み。表示する階層はCSSで切り替える
+            document.documentElement.setAttribute('data-toc-enabled', settings.tocEnabled === false ? 'false' : 'true');
+            document.documentElement.setAttribute('data-toc-level', String(settings.tocLevel || 1));
         }})();
         
         function applyPresentationMarginSetting() {{
@@ -2204,6 +2329,9 @@ def get_print_html_template():
         let presentationSections = [];
         let presentationIndex = 0;
         const PRESENTATION_STATE_KEY = 'mdf2h-presentation-state';
+        // 表示中以外のスライドを隠すスタイル（スライド切替時は要素ごとではなくこのルール1つを書き換える）
+        const presentationVisibilityStyle = document.createElement('style');
+        document.head.appendChild(presentationVisibilityStyle);
 
         function savePresentationState() {{
             if (presentationMode) {{
@@ -2225,7 +2353,7 @@ def get_print_html_template():
                         presentationMode = true;
                         document.body.classList.add('mdf2h-presentation-mode');
                         applyPresentationMarginSetting();
-                        presentationSections = buildPresentationSections();
+                        presentationSections = getPresentationSections();
                         presentationIndex = Math.min(state.index || 0, Math.max(0, presentationSections.length - 1));
                         applyPresentationVisibility();
                     }}
@@ -2235,212 +2363,74 @@ def get_print_html_template():
             }}
         }}
 
+        // スライド分割の結果は本文直下の要素が変わらない限り使い回す（直下の要素の追加・削除で破棄）
+        let presentationSectionsCache = null;
+        if (articleEl) {{
+            new MutationObserver(() => {{
+                presentationSectionsCache = null;
+            }}).observe(articleEl, {{ childList: true }});
+        }}
+        
+        function getPresentationSections() {{
+            if (!presentationSectionsCache) {{
+                presentationSectionsCache = buildPresentationSections();
+            }}
+            return presentationSectionsCache;
+        }}
+        
         function isPresentationBoundary(el) {{
             return el && (el.tagName === 'H1' || el.tagName === 'H2');
         }}
 
         function buildPresentationSections() {{
-            const article = document.querySelector('.markdown-body');
+            const article = articleEl;
             if (!article) return [];
-            const children = Array.from(article.children);
             const sections = [];
             let current = null;
 
-            children.forEach((el) => {{
+            // 子要素の配列コピーは作らず、HTMLCollection をそのまま走査する（走査中にDOMは変更しない）
+            for (const el of article.children) {{
                 if (el.classList.contains('mdf2h-print-toc') || el.classList.contains('mdf2h-print-credits')) {{
-                    return;
+                    continue;
                 }}
                 if (isPresentationBoundary(el)) {{
                     if (current && current.length > 0) {{
                         sections.push(current);
                     }}
                     current = [el];
-                    return;
+                    continue;
                 }}
                 if (!current) {{
                     current = [el];
                 }} else {{
                     current.push(el);
                 }}
-            }});
+            }}
             if (current && current.length > 0) {{
                 sections.push(current);
             }}
-            return sections.length > 0 ? sections : [children];
+            const result = sections.length > 0 ? sections : [Array.from(article.children)];
+            // 各要素に所属するスライドの番号を付けておく
+            result.forEach((section, index) => {{
+                section.forEach((el) => {{
+                    el.dataset.presIdx = String(index);
+                }});
+            }});
+            return result;
         }}
 
         function clearPresentationHidden() {{
-            const article = document.querySelector('.markdown-body');
-            if (!article) return;
-            article.querySelectorAll('.mdf2h-presentation-hidden').forEach((el) => {{
-                el.classList.remove('mdf2h-presentation-hidden');
-            }});
+            presentationVisibilityStyle.textContent = '';
         }}
 
         function applyPresentationVisibility() {{
             const sections = presentationSections;
             if (!sections || sections.length === 0) return;
-            sections.forEach((section, index) => {{
-                const hidden = index !== presentationIndex;
-                section.forEach((el) => {{
-                    if (hidden) {{
-                        el.classList.add('mdf2h-presentation-hidden');
-                    }} else {{
-                        el.classList.remove('mdf2h-presentation-hidden');
-                    }}
-                }});
-            }});
-            const activeSection = sections[presentationIndex] || [];
+            presentationVisibilityStyle.textContent =
+                `.markdown-body > [data-pres-idx]:not([data-pres-idx="${{presentationIndex}}"]) {{ display: none !important; }}`;
             // プレゼンモードでは常にページトップから表示を開始
             // scrollIntoView(smooth)はDOMの変更タイミングとずれるため使用しない
             window.scrollTo(0, 0);
-            const sectionHeights = activeSection.slice(0, 6).map((el) => {{
-                const r = el.getBoundingClientRect();
-                return {{ tag: el.tagName, height: Math.round(r.height) }};
-            }});
-            const article = document.querySelector('.markdown-body');
-            const activeHeading = activeSection.find(el => el.tagName === 'H1' || el.tagName === 'H2');
-            let articleRect = null;
-            let articleStyle = null;
-            let headingRect = null;
-            let headingStyle = null;
-            if (article) {{
-                const rect = article.getBoundingClientRect();
-                articleRect = {{ width: Math.round(rect.width), left: Math.round(rect.left), right: Math.round(rect.right) }};
-                const style = window.getComputedStyle(article);
-                articleStyle = {{
-                    paddingLeft: style.paddingLeft,
-                    paddingRight: style.paddingRight,
-                    marginLeft: style.marginLeft,
-                    marginRight: style.marginRight,
-                    maxWidth: style.maxWidth,
-                    width: style.width
-                }};
-            }}
-            if (activeHeading) {{
-                const rect = activeHeading.getBoundingClientRect();
-                headingRect = {{
-                    width: Math.round(rect.width),
-                    left: Math.round(rect.left),
-                    right: Math.round(rect.right),
-                    top: Math.round(rect.top),
-                    bottom: Math.round(rect.bottom)
-                }};
-                const style = window.getComputedStyle(activeHeading);
-                headingStyle = {{
-                    marginTop: style.marginTop,
-                    marginBottom: style.marginBottom,
-                    scrollMarginTop: style.scrollMarginTop
-                }};
-            }}
-            const hiddenElements = Array.from(document.querySelectorAll('.mdf2h-presentation-hidden'));
-            const hiddenSample = hiddenElements[0];
-            const hiddenSampleStyle = hiddenSample ? window.getComputedStyle(hiddenSample).display : null;
-            const bodyHasClass = document.body ? document.body.classList.contains('mdf2h-presentation-mode') : false;
-            const visibleH2 = [];
-            const h2s = Array.from(document.querySelectorAll('.markdown-body h2'));
-            h2s.forEach((h2) => {{
-                const display = window.getComputedStyle(h2).display;
-                if (display !== 'none') {{
-                    visibleH2.push((h2.textContent || '').trim());
-                }}
-            }});
-            const activeTables = activeSection.filter(el => el.tagName === 'TABLE');
-            if (activeTables.length > 0) {{
-                const tableRects = activeTables.slice(0, 2).map(t => {{
-                    const r = t.getBoundingClientRect();
-                    const style = window.getComputedStyle(t);
-                    return {{
-                        width: Math.round(r.width),
-                        left: Math.round(r.left),
-                        right: Math.round(r.right),
-                        styleWidth: style.width,
-                        marginLeft: style.marginLeft,
-                        marginRight: style.marginRight
-                    }};
-                }});
-            }}
-            if (docEl) {{
-            }}
-
-            let minLeft = null;
-            let maxRight = null;
-            let minLeftTag = null;
-            let maxRightTag = null;
-            activeSection.forEach((el) => {{
-                const r = el.getBoundingClientRect();
-                if (minLeft === null || r.left < minLeft) {{
-                    minLeft = r.left;
-                    minLeftTag = el.tagName;
-                }}
-                if (maxRight === null || r.right > maxRight) {{
-                    maxRight = r.right;
-                    maxRightTag = el.tagName;
-                }}
-            }});
-            const specialNodes = [];
-            activeSection.forEach((el) => {{
-                if (el.matches && (el.matches('table, pre, code, svg, .mermaid'))) {{
-                    specialNodes.push(el);
-                }}
-                el.querySelectorAll && el.querySelectorAll('table, pre, code, svg, .mermaid').forEach((node) => {{
-                    specialNodes.push(node);
-                }});
-            }});
-            if (specialNodes.length > 0) {{
-                const sample = specialNodes.slice(0, 4).map((node) => {{
-                    const r = node.getBoundingClientRect();
-                    const style = window.getComputedStyle(node);
-                    return {{
-                        tag: node.tagName,
-                        left: Math.round(r.left),
-                        right: Math.round(r.right),
-                        width: Math.round(r.width),
-                        styleWidth: style.width,
-                        styleMarginLeft: style.marginLeft,
-                        styleMarginRight: style.marginRight,
-                        display: style.display,
-                        attrWidth: node.getAttribute ? node.getAttribute('width') : null,
-                        attrHeight: node.getAttribute ? node.getAttribute('height') : null,
-                        viewBox: node.getAttribute ? node.getAttribute('viewBox') : null
-                    }};
-                }});
-            }}
-
-            const blockSample = [];
-            activeSection.forEach((el) => {{
-                if (!el.tagName) return;
-                const tag = el.tagName;
-                if (!['H1','H2','H3','P','UL','OL','TABLE','PRE','DIV','BLOCKQUOTE'].includes(tag)) return;
-                if (blockSample.length >= 6) return;
-                const r = el.getBoundingClientRect();
-                const style = window.getComputedStyle(el);
-                blockSample.push({{
-                    tag,
-                    left: Math.round(r.left),
-                    right: Math.round(r.right),
-                    width: Math.round(r.width),
-                    paddingLeft: style.paddingLeft,
-                    marginLeft: style.marginLeft,
-                    paddingRight: style.paddingRight,
-                    marginRight: style.marginRight
-                }});
-            }});
-            if (blockSample.length > 0) {{
-            }}
-
-            if (articleRect) {{
-                let maxRatio = 0;
-                let maxTag = null;
-                activeSection.forEach((el) => {{
-                    const r = el.getBoundingClientRect();
-                    const ratio = r.width / articleRect.width;
-                    if (ratio > maxRatio) {{
-                        maxRatio = ratio;
-                        maxTag = el.tagName;
-                    }}
-                }});
-            }}
         }}
 
         function findSectionIndexForElement(el) {{
@@ -2489,7 +2479,7 @@ def get_print_html_template():
             if (presentationMode) {{
                 // 設定から余白を適用
                 applyPresentationMarginSetting();
-                presentationSections = buildPresentationSections();
+                presentationSections = getPresentationSections();
                 const active = document.activeElement;
                 const targetIndex = findSectionIndexForElement(active);
                 presentationIndex = targetIndex >= 0 ? targetIndex : 0;
@@ -2510,6 +2500,108 @@ def get_print_html_template():
         }}
         
         // ========== キーボードショートカット ==========
+        // 入力欄・編集中の要素かどうか（文字入力中はショートカットを処理しない）
+        function isEditableTarget(el) {{
+            return !!el && (el.isContentEditable || el.tagName === 'INPUT' || el.tagName === 'TEXTAREA' || el.tagName === 'SELECT');
+        }}
+        
+        // '修飾キー|キー' -> 処理（処理した場合は true を返し、既定の動作を止める）
+        // 修飾キーは C=Ctrl, A=Alt, S=Shift の順で並べ、英字キーは小文字で登録する
+        const SHORTCUTS = new Map();
+        
+        function addShortcut(masks, keys, handler) {{
+            masks.forEach((mask) => {{
+                keys.forEach((key) => SHORTCUTS.set(mask + '|' + key, handler));
+            }});
+        }}
+        
+        // Ctrl+Alt の組み合わせは Shift の有無を問わない
+        const CTRL_ALT = ['CA', 'CAS'];
+        
+        // Ctrl+Alt+A: ルートへ移動
+        addShortcut(['CA'], ['a'], () => {{
+            window.location.href = '/';
+            return true;
+        }});
+        // Ctrl+Shift+↑ / Ctrl+Alt+↑: 親ディレクトリへ移動
+        // （Windowsでは Ctrl+Alt+矢印 がシステムに取られるため Ctrl+Shift+矢印 を代替とする）
+        addShortcut(['CS', ...CTRL_ALT], ['ArrowUp'], () => {{
+            navigateToParent();
+            return true;
+        }});
+        // Ctrl+Shift+←→: 前後のページへ移動
+        addShortcut(['CS'], ['ArrowRight'], () => {{
+            navigateToNext();
+            return true;
+        }});
+        addShortcut(['CS'], ['ArrowLeft'], () => {{
+            navigateToPrev();
+            return true;
+        }});
+        // Ctrl+Alt+←→: 前後のページへ移動（編集モード中は無効）
+        addShortcut(CTRL_ALT, ['ArrowRight'], () => {{
+            if (editMode) return false;
+            navigateToNext();
+            return true;
+        }});
+        addShortcut(CTRL_ALT, ['ArrowLeft'], () => {{
+            if (editMode) return false;
+            navigateToPrev();
+            return true;
+        }});
+        // Ctrl+Alt+E: 編集モード切替（編集モード中に再度押すと保存）
+        addShortcut(CTRL_ALT, ['e'], () => {{
+            if (editMode) {{
+                saveChanges();
+            }} else {{
+                toggleEditMode();
+            }}
+            return true;
+        }});
+        // Ctrl+Alt+P: プレゼンモード切替（編集モード中は無効）
+        addShortcut(CTRL_ALT, ['p'], () => {{
+            if (editMode) return false;
+            togglePresentationMode();
+            return true;
+        }});
+        // Ctrl+Alt+T / Ctrl+Alt+3: H2 / H3 をまとめて折りたたみ
+        addShortcut(CTRL_ALT, ['t'], () => {{
+            toggleAllH2();
+            return true;
+        }});
+        addShortcut(CTRL_ALT, ['3'], () => {{
+            toggleAllH3();
+            return true;
+        }});
+        // Enter / Ctrl+Enter: フォーカス/ホバー中の見出しを折りたたみ（編集モード中は無効）
+        addShortcut(['', 'C', 'CA', 'CS', 'CAS'], ['Enter'], () => !editMode && toggleHoverHeading());
+        // 矢印キー（修飾キーなし）: プレゼンモードではスクロール・ページ移動、通常モードではフォーカス移動
+        // 編集モード中はブラウザのデフォルト動作に任せる（テキスト編集用カーソル移動）
+        addShortcut([''], ['ArrowDown', 'ArrowUp', 'ArrowRight', 'ArrowLeft'], (key) => {{
+            if (editMode) return false;
+            if (presentationMode) {{
+                if (key === 'ArrowDown') {{
+                    window.scrollBy({{ top: 100, behavior: 'smooth' }});
+                }} else if (key === 'ArrowUp') {{
+                    window.scrollBy({{ top: -100, behavior: 'smooth' }});
+                }} else if (key === 'ArrowRight') {{
+                    gotoPresentation(1);
+                }} else {{
+                    gotoPresentation(-1);
+                }}
+                return true;
+            }}
+            if (key === 'ArrowDown') {{
+                focusNext();
+                return true;
+            }}
+            if (key === 'ArrowUp') {{
+                focusPrev();
+                return true;
+            }}
+            return false;
+        }});
+        
         document.addEventListener('keydown', (e) => {{
             // Escape: 編集モード中で要素にフォーカスがなければ編集モードを保存せず終了
             if (e.key === 'Escape' && editMode) {{
@@ -2524,131 +2616,21 @@ def get_print_html_template():
                 }}
             }}
             
-            // Ctrl+Alt+A: ルートへ移動
-            if (e.ctrlKey && e.altKey && !e.shiftKey && (e.key === 'a' || e.key === 'A')) {{
+            // 押された修飾キーとキーで処理を引く（Metaキーだけが押されている場合は何もしない）
+            const mask = (e.ctrlKey ? 'C' : '') + (e.altKey ? 'A' : '') + (e.shiftKey ? 'S' : '');
+            if (e.metaKey && !mask) return;
+            const key = e.key.length === 1 ? e.key.toLowerCase() : e.key;
+            // 入力欄・編集中の要素では編集内容の保存（Ctrl+Alt+E）だけを受け付ける
+            if (isEditableTarget(e.target) && !(mask.startsWith('CA') && key === 'e')) return;
+            const handler = SHORTCUTS.get(mask + '|' + key);
+            if (handler && handler(key)) {{
                 e.preventDefault();
-                window.location.href = '/';
-                return;
-            }}
-            
-            // Ctrl+Shift+矢印: ナビゲーション（Windowsでは Ctrl+Alt+矢印 がシステムに取られるため代替）
-            if (e.ctrlKey && e.shiftKey && !e.altKey) {{
-                switch(e.key) {{
-                    case 'ArrowUp':
-                        e.preventDefault();
-                        navigateToParent();
-                        return;
-                    case 'ArrowRight':
-                        e.preventDefault();
-                        navigateToNext();
-                        return;
-                    case 'ArrowLeft':
-                        e.preventDefault();
-                        navigateToPrev();
-                        return;
-                }}
-            }}
-            
-            // Ctrl+Alt+矢印: ナビゲーション（macOS向け、Windowsでは動作しない場合あり）
-            if (e.ctrlKey && e.altKey) {{
-                switch(e.key) {{
-                    case 'e':
-                    case 'E':
-                        e.preventDefault();
-                        // 編集モード中に再度押すと保存
-                        if (editMode) {{
-                            saveChanges();
-                        }} else {{
-                            toggleEditMode();
-                        }}
-                        return;
-                    case 'p':
-                    case 'P':
-                        // 編集モード中はプレゼンモード切替を無効化
-                        if (editMode) return;
-                        e.preventDefault();
-                        togglePresentationMode();
-                        return;
-                    case 'ArrowUp':
-                        e.preventDefault();
-                        navigateToParent();
-                        return;
-                    case 'ArrowRight':
-                        // 編集モード中はナビゲーション無効化
-                        if (editMode) return;
-                        e.preventDefault();
-                        navigateToNext();
-                        return;
-                    case 'ArrowLeft':
-                        // 編集モード中はナビゲーション無効化
-                        if (editMode) return;
-                        e.preventDefault();
-                        navigateToPrev();
-                        return;
-                    case 't':
-                    case 'T':
-                        e.preventDefault();
-                        toggleAllH2();
-                        return;
-                    case '3':
-                        e.preventDefault();
-                        toggleAllH3();
-                        return;
-                }}
-            }}
-            
-            // Enter: フォーカス/ホバー中の見出しを折りたたみ（編集モード中は無効）
-            if (!editMode && !e.ctrlKey && !e.altKey && !e.shiftKey && !e.metaKey && e.key === 'Enter') {{
-                if (toggleHoverHeading()) {{
-                    e.preventDefault();
-                    return;
-                }}
-            }}
-            
-            // Ctrl+Enter: フォーカス/ホバー中の見出しを折りたたみ（編集モード中は無効）
-            if (!editMode && e.ctrlKey && e.key === 'Enter') {{
-                if (toggleHoverHeading()) {{
-                    e.preventDefault();
-                    return;
-                }}
-            }}
-            
-            // ↑↓キー（修飾キーなし）: プレゼンモードではスクロール、通常モードではフォーカス移動
-            // 編集モード中はブラウザのデフォルト動作に任せる（テキスト編集用カーソル移動）
-            if (!e.ctrlKey && !e.altKey && !e.shiftKey && !e.metaKey) {{
-                if (editMode) {{
-                    // 編集モード中: ブラウザデフォルト動作（矢印キーでカーソル移動）
-                    return;
-                }} else if (presentationMode) {{
-                    // プレゼンモード: ↑↓でスクロール、←→でページ移動
-                    if (e.key === 'ArrowDown') {{
-                        e.preventDefault();
-                        window.scrollBy({{ top: 100, behavior: 'smooth' }});
-                    }} else if (e.key === 'ArrowUp') {{
-                        e.preventDefault();
-                        window.scrollBy({{ top: -100, behavior: 'smooth' }});
-                    }} else if (e.key === 'ArrowRight') {{
-                        e.preventDefault();
-                        gotoPresentation(1);
-                    }} else if (e.key === 'ArrowLeft') {{
-                        e.preventDefault();
-                        gotoPresentation(-1);
-                    }}
-                }} else {{
-                    // 通常モード: ↑↓でフォーカス移動
-                    if (e.key === 'ArrowDown') {{
-                        e.preventDefault();
-                        focusNext();
-                    }} else if (e.key === 'ArrowUp') {{
-                        e.preventDefault();
-                        focusPrev();
-                    }}
-                }}
             }}
         }});
         
         // ========== 設定ダイアログ ==========
         function saveSettings(settings) {{
+            settingsCache = settings;
             try {{
                 localStorage.setItem(SETTINGS_KEY, JSON.stringify(settings));
             }} catch (e) {{
@@ -2656,20 +2638,31 @@ def get_print_html_template():
             }}
         }}
         
-        // 初期化
+        // 非表示になったタブはロングポーリングを中断し、再表示されたら再開する（編集中は停止したまま）
+        document.addEventListener('visibilitychange', () => {{
+            if (document.hidden) {{
+                stopAutoReload();
+            }} else if (!autoReloadAbort && !editMode) {{
+                initAutoReload(true);
+            }}
+        }});
+        
+        // 初期化（読み込み時の処理はこの1つのリスナーにまとめる）
         window.addEventListener('load', async () => {{
+            initHashScroll();
+            initAutoReload();
+            // 印刷直前の fetch を避けるため credits は読み込み後に用意しておくが、初期表示を妨げないよう空き時間に行う
+            runWhenIdle(generatePrintContent);
             // mermaidの全ブロックレンダリング完了を待つ（プレゼンモード復元前に必須）
             try {{
                 await mermaid.run();
             }} catch (e) {{
                 console.warn('Mermaid rendering error:', e);
             }}
-            loadNavInfo();
+            runWhenIdle(loadNavInfo);
             initFoldableHeadings();
             initFocusableElements();
             insertLogo();
-            initCodeCopyButtons();
-            insertTocUnderH1();
             initImageListItems();
             initImageSizeToggle();
             initTableSizeToggle();
@@ -2688,3 +2681,11 @@ def get_print_html_template():
     </article>
 </body>
 </html>'''
+
+# 事前に分解したMarkdown表示用テンプレート（render_template_chunks() で使用）
+PRINT_HTML_TEMPLATE_PARTS = split_template(PRINT_HTML_TEMPLATE)
+
+
+def get_print_html_template():
+    """Markdown表示用HTMLテンプレートを返す（Ctrl+P印刷対応）"""
+    return PRINT_HTML_TEMPLATE
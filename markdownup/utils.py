@@ -1,42 +1,53 @@
 # -*- coding: utf-8 -*-
 """ユーティリティ関数群"""
 
+import functools
 import re
-import sys
 import os
 import socket
-import socketserver
 from pathlib import Path
 
-from .constants import DEFAULT_PORT, FALLBACK_PORTS
+from .constants import DEFAULT_PORT, FALLBACK_PORTS, IS_WINDOWS
 
+# githubish_slugify 用の変換テーブル（見出しごとに呼ばれるため事前に構築）
+# ASCII英数字は小文字で残し、それ以外のASCII文字と全角の区切り記号は区切り文字に置換する。
+# テーブルにない非ASCII文字（日本語など）はそのまま残るため、後段で除去する
+_SLUG_GAP = "\0"
+_SLUG_TRANSLATION = {
+    code: (chr(code).lower() if chr(code).isalnum() else _SLUG_GAP)
+    for code in range(128)
+}
+_SLUG_TRANSLATION.update((ord(c), _SLUG_GAP) for c in "（）【】．・⇔")
+_SLUG_GAP_RUN_PATTERN = re.compile(_SLUG_GAP + "+")
 
+
+@functools.lru_cache(maxsize=4096)
 def githubish_slugify(value: str, separator: str = "-") -> str:
     """
     見出し文字列から安全なアンカーIDを生成する。
     - ASCII文字（a-z, 0-9）とハイフンのみを保持
     - 日本語や記号は除去または置換
     - 例: "5.5 ES10a Functions（IPA ⇔ eUICC の ISD-R）" -> "5-5-es10a-functions-ipa-euicc-isd-r"
+    - 同じ見出しは何度も変換されるため、結果をキャッシュする
     """
-    import unicodedata
-    # 小文字化して前後の空白を削除
-    v = (value or "").strip().lower()
-    # 日本語などのUnicodeを正規化してASCIIに近い形にする（可能な場合）
-    # ただし、今回は「文字化けしない文字」を目指すため、非ASCIIは基本的に除去
-    
-    # 記号をスペースに置換
-    v = re.sub(r"[()（）【】\[\]<>:;,/\\\\.．・⇔<=>+]", " ", v)
-    
-    # 非ASCII文字（日本語など）を除去
-    v = "".join(c for c in v if ord(c) < 128)
-    
-    # 英数字以外をセパレータに置換
-    v = re.sub(r"[^a-z0-9]+", separator, v)
-    
-    # 連続するセパレータを1つにまとめ、前後のセパレータを削除
-    v = re.sub(re.escape(separator) + r"{2,}", separator, v).strip(separator)
+    v = value or ""
+    # 「文字化けしない文字」を目指すため、Unicodeの正規化は行わず非ASCIIは基本的に除去する
+    if v.isascii():
+        # ASCIIのみの見出し（大半）は translate だけで済む（大文字も変換テーブルで小文字化される）
+        v = v.translate(_SLUG_TRANSLATION)
+    else:
+        # 大文字の非ASCII文字がASCIIに小文字化される場合があるため、先に小文字化する
+        # 英数字以外の記号・空白は区切り文字に置換（1回の translate で処理）
+        v = v.lower().translate(_SLUG_TRANSLATION)
+        # 非ASCII文字（日本語など）を除去
+        v = v.encode("ascii", "ignore").decode("ascii")
     
-    return v
+    # 前後の区切りを削除し、連続する区切りを1つのセパレータにまとめる
+    v = v.strip(_SLUG_GAP)
+    if _SLUG_GAP * 2 not in v:
+        # 区切りが連続していなければ（大半の見出し）、正規表現を使わず置換だけで済む
+        return v.replace(_SLUG_GAP, separator)
+    return _SLUG_GAP_RUN_PATTERN.sub(separator, v)
 
 
 def find_available_port(preferred_port):
@@ -47,18 +58,19 @@ def find_available_port(preferred_port):
         try:
             # ポートが使用可能か確認
             # Windowsの場合はIPv4で確認（localhostで確認）
-            if sys.platform == 'win32':
+            if IS_WINDOWS:
                 test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 # WindowsではSO_REUSEADDRが他と挙動が異なるため、チェック時は使わない
                 test_socket.bind(('localhost', port))
                 test_socket.close()
             else:
-                # Linux/macOSの場合はIPv6で確認
-                socketserver.TCPServer.address_family = socket.AF_INET6
-                test_socket = socketserver.TCPServer(("::", port), None, bind_and_activate=False)
-                test_socket.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
-                test_socket.server_bind()
-                test_socket.server_close()
+                # Linux/macOSの場合はIPv6（デュアルスタック）で確認
+                # サーバーと同じく SO_REUSEADDR を付け、TIME_WAIT の残るポートは使用可能とみなす
+                # （socketserver.TCPServer のクラス属性を書き換えないよう、素のソケットで確認する）
+                with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as test_socket:
+                    test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    test_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+                    test_socket.bind(("::", port))
             return port
         except OSError as e:
             # 10048: Address already in use
@@ -101,56 +113,3 @@ def resolve_target_directory(directory_arg: str) -> Path:
         target_dir = target_dir.resolve()
 
     return target_dir
-
-
-def is_directory_only_invocation(argv):
-    """-d/--directory だけが指定された起動かどうか（値のトークンは除外して判定）"""
-    has_directory = False
-    other_options = []
-
-    i = 0
-    while i < len(argv):
-        tok = argv[i]
-        if tok in ('-d', '--directory'):
-            has_directory = True
-            i += 2  # 値もスキップ
-            continue
-        if tok.startswith('--directory='):
-            has_directory = True
-            i += 1
-            continue
-        if tok.startswith('-'):
-            other_options.append(tok)
-        i += 1
-
-    return has_directory and len(other_options) == 0
-
-
-def is_port_without_start_invocation(argv):
-    """--start なしで --port/-p が指定された起動かどうか（値のトークンは除外して判定）"""
-    has_start = False
-    has_port = False
-    has_child = False
-
-    i = 0
-    while i < len(argv):
-        tok = argv[i]
-        if tok == '--start':
-            has_start = True
-            i += 1
-            continue
-        if tok == '--_child':
-            has_child = True
-            i += 1
-            continue
-        if tok in ('-p', '--port'):
-            has_port = True
-            i += 2  # 値もスキップ
-            continue
-        if tok.startswith('--port='):
-            has_port = True
-            i += 1
-            continue
-        i += 1
-
-    return has_port and not has_start and not has_child